@@ -1,3 +1,4 @@
+from typing import Optional, Tuple
 from uuid import uuid4
 
 from fastapi import APIRouter, Depends, HTTPException, status
@@ -5,9 +6,10 @@ from fastapi.security import OAuth2PasswordBearer
 from datetime import timedelta
 from pydantic import BaseModel
 
-from core.config import jwt_settings
-from core.security import verify_password, create_access_token, decode_access_token
-from db.repositories.user_repository import get_user_by_username, create_user, delete_messages_by_sender
+from core.config import jwt_settings, auth_settings
+from core.security import averify_password, create_access_token, decode_access_token
+from db.models.user import User, ANONYMOUS_USERNAME_PREFIX
+from db.repositories.user_repository import get_user_by_username, get_cached_user_by_username, create_user
 from api.models.requests import TokenRequest, RegisterRequest
 
 router = APIRouter()
@@ -21,12 +23,12 @@ class Token(BaseModel):
 
 async def authenticate_user(username: str, password: str):
     user = await get_user_by_username(username)
-    if not user or not verify_password(password, user.hashed_password):
+    if not user or not await averify_password(password, user.hashed_password):
         return False
     return user
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+def _decode_token_or_401(token: str) -> dict:
     payload = decode_access_token(token)
     if payload is None:
         raise HTTPException(
@@ -34,30 +36,71 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    return await get_user_by_username(payload.get("sub"))
+    return payload
+
+
+async def _resolve_user(payload: dict) -> User:
+    if payload.get("anon"):
+        # Stateless anonymous sessions have no user document; the signed token is the whole identity
+        return User(username=payload.get("sub"), hashed_password="")
+    user = await get_cached_user_by_username(payload.get("sub"))
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    return await _resolve_user(_decode_token_or_401(token))
+
+
+async def get_current_username(token: str = Depends(oauth2_scheme)) -> str:
+    username, _ = await authenticate_token(token)
+    return username
+
+
+async def authenticate_token(token: str) -> Tuple[str, Optional[int]]:
+    """
+    Validates a token and returns its username and expiry (a Unix timestamp, if the token has one).
+    Long-lived connections call this once and check the expiry themselves.
+    """
+    payload = _decode_token_or_401(token)
+    if auth_settings.TRUST_TOKEN_CLAIMS or payload.get("anon"):
+        return payload.get("sub"), payload.get("exp")
+    return (await _resolve_user(payload)).username, payload.get("exp")
 
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token():
     # Generate a unique username using UUID
-    unique_username = f"user_{uuid4()}"
-    # For demonstration, we use a fixed password pattern, could be randomized similarly
-    password = "defaultPassword123"
-
-    # Create a new user with the generated unique username and password
-    await create_user(unique_username, password)
-
-    # Delete messages for this user, though they shouldn't have any
-    await delete_messages_by_sender(unique_username)
+    unique_username = f"{ANONYMOUS_USERNAME_PREFIX}{uuid4()}"
+    token_data = {"sub": unique_username}
+
+    if auth_settings.ANONYMOUS_SESSION_MODE == "persistent":
+        # For demonstration, we use a fixed password pattern, could be randomized similarly
+        password = "defaultPassword123"
+        # Create a new user with the generated unique username and password
+        await create_user(unique_username, password)
+    else:
+        # A fresh UUID cannot have a user document or messages, so nothing needs to be written
+        token_data["anon"] = True
 
     # Create token with short expiration for temporary access
     access_token_expires = timedelta(seconds=jwt_settings.EXPIRATION_SECONDS)
-    access_token = create_access_token(data={"sub": unique_username}, expires_delta=access_token_expires)
+    access_token = create_access_token(data=token_data, expires_delta=access_token_expires)
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @router.post("/register")
 async def register_user(register_request: RegisterRequest):
+    if register_request.username.startswith(ANONYMOUS_USERNAME_PREFIX):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Usernames starting with '{ANONYMOUS_USERNAME_PREFIX}' are reserved"
+        )
     user = await get_user_by_username(register_request.username)
     if user:
         raise HTTPException(
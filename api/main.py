@@ -1,15 +1,35 @@
-from fastapi import FastAPI, Depends
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+from fastapi import FastAPI, Depends, HTTPException, Request, WebSocket, WebSocketDisconnect, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 
-from api.models.requests import ProcessRequest
-from application.langchain_lib import process_user_prompt
-from api.auth import get_current_user
+from api.models.requests import ProcessRequest, BatchProcessRequest
+from application.chat_session import ChatSession
+from application.langchain_lib import process_user_prompt, stream_user_prompt, RetrievalTimeoutError, warm_up, \
+    remember_turn, conversation_memory, start_snapshot_watcher, stop_snapshot_watcher, process_user_prompts, \
+    index_user_message, recall_user_messages, user_message_indexer
+from api.auth import get_current_username, authenticate_token
 from api.auth import router as auth_router
+from core.admission import OverloadedError
+from core.config import metrics_settings, snapshot_settings, batch_settings, user_memory_settings
+from core.metrics import MetricsMiddleware, render_metrics
 from db.database import initialize_database
-from db.models.user import User
-from db.repositories.user_repository import create_message, get_last_n_messages, get_all_messages_by_username
+from db.repositories.message_buckets import message_buckets
+from db.repositories.message_writer import message_writer
+from db.repositories.text_file_repository import warm_text_file_cache, start_text_file_watcher, \
+    stop_text_file_watcher
+from db.repositories.user_repository import create_message, get_last_n_messages, get_messages_by_username, \
+    iter_raw_messages, encode_message_cursor, decode_message_cursor
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
+app.state.ready = False
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,12 +37,82 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(MetricsMiddleware, server_timing=metrics_settings.SERVER_TIMING)
+
+
+# Seconds between warm-up attempts while an essential step keeps failing, doubling up to the maximum
+WARM_UP_RETRY_SECONDS = 1
+WARM_UP_MAX_RETRY_SECONDS = 30
+
+
+async def warm_up_app():
+    delay = WARM_UP_RETRY_SECONDS
+    while True:
+        # Workers sharing a snapshot read document text from it instead of each caching its own copy
+        if not snapshot_settings.ENABLED:
+            try:
+                await warm_text_file_cache()
+            except Exception:
+                # Documents are cached on demand by the first requests instead
+                logger.exception("Failed to warm the document cache")
+        if await warm_up():
+            break
+        # /ready keeps reporting 503 until the routes, tokenizer and vector index have loaded
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WARM_UP_MAX_RETRY_SECONDS)
+    app.state.ready = True
 
 
 @app.on_event("startup")
 async def on_startup():
     await initialize_database()
+    start_text_file_watcher()
+    if message_writer is not None:
+        message_writer.start()
+    if message_buckets is not None:
+        message_buckets.start()
+    if user_message_indexer is not None:
+        user_message_indexer.start()
+    # Warm up in the background so the worker accepts connections right away; /ready reports when it is done
+    app.state.warm_up_task = asyncio.create_task(warm_up_app())
+    start_snapshot_watcher()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.warm_up_task.cancel()
+    await stop_snapshot_watcher()
+    await stop_text_file_watcher()
+    if conversation_memory is not None:
+        await conversation_memory.stop()
+    if user_message_indexer is not None:
+        await user_message_indexer.stop()
+    if message_buckets is not None:
+        await message_buckets.stop()
+    if message_writer is not None:
+        await message_writer.stop()
+
+
+@app.exception_handler(RetrievalTimeoutError)
+async def retrieval_timeout_handler(request: Request, exc: RetrievalTimeoutError):
+    return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content={"detail": str(exc)})
+
+
+@app.exception_handler(OverloadedError)
+async def overloaded_handler(request: Request, exc: OverloadedError):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
+def validate_cursor(before: Optional[str]):
+    if before is None:
+        return
+    try:
+        decode_message_cursor(before)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor")
 
 
 @app.get("/")
@@ -30,22 +120,148 @@ def read_root():
     return {"message": "Welcome"}
 
 
+@app.get("/ready", include_in_schema=False)
+def ready():
+    if not app.state.ready:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "warming up"})
+    return {"status": "ready"}
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/process/")
-async def process(input_data: ProcessRequest, user: User = Depends(get_current_user)):
-    await create_message(user.username, input_data.input_text, True)
-    result = await process_user_prompt(input_data.input_text, user.username)
-    await create_message(user.username, result['result'].content, False)
+async def process(input_data: ProcessRequest, username: str = Depends(get_current_username)):
+    message_id = await create_message(username, input_data.input_text, True)
+    index_user_message(username, message_id, input_data.input_text)
+    result = await process_user_prompt(input_data.input_text, username)
+    await create_message(username, result['result'].content, False)
+    remember_turn(username)
     return {"processed_text": result}
 
 
+@app.post("/process/batch")
+async def process_batch(input_data: BatchProcessRequest, username: str = Depends(get_current_username)):
+    if len(input_data.inputs) > batch_settings.MAX_PROMPTS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"A batch holds at most {batch_settings.MAX_PROMPTS} prompts")
+    # Batched prompts are answered independently and are not added to the user's history
+    return {"results": await process_user_prompts(input_data.inputs)}
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/process/stream")
+async def process_stream(input_data: ProcessRequest, username: str = Depends(get_current_username)):
+    message_id = await create_message(username, input_data.input_text, True)
+    index_user_message(username, message_id, input_data.input_text)
+
+    async def stream_events():
+        reply = []
+        try:
+            async for event in stream_user_prompt(input_data.input_text, username):
+                if "token" in event:
+                    reply.append(event["token"])
+                    yield format_sse("token", event)
+                else:
+                    yield format_sse("source", event)
+            yield format_sse("done", {})
+        except RetrievalTimeoutError as exc:
+            yield format_sse("error", {"detail": str(exc)})
+        except OverloadedError as exc:
+            yield format_sse("error", {"detail": str(exc), "retry_after": exc.retry_after})
+        finally:
+            if reply:
+                await create_message(username, "".join(reply), False)
+                remember_turn(username)
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket, token: str = ""):
+    # Authenticated once per connection; browsers cannot set headers on WebSocket requests, so the token is a query
+    # parameter
+    try:
+        username, expires_at = await authenticate_token(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    session = ChatSession(username)
+    await session.open()
+    try:
+        while True:
+            try:
+                data = json.loads(await websocket.receive_text())
+            except ValueError:
+                data = None
+            if expires_at is not None and time.time() >= expires_at:
+                await websocket.send_json({"event": "error", "detail": "Token expired"})
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                break
+            prompt = data.get("input_text") if isinstance(data, dict) else None
+            if not isinstance(prompt, str):
+                await websocket.send_json({"event": "error", "detail": "Expected {\"input_text\": \"...\"}"})
+                continue
+            try:
+                async for event in session.stream_turn(prompt):
+                    await websocket.send_json({"event": "token" if "token" in event else "source", **event})
+                await websocket.send_json({"event": "done"})
+            except RetrievalTimeoutError as exc:
+                await websocket.send_json({"event": "error", "detail": str(exc)})
+            except OverloadedError as exc:
+                await websocket.send_json({"event": "error", "detail": str(exc), "retry_after": exc.retry_after})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await session.close()
+
+
+@app.get("/user/last_messages/raw")
+async def get_last_messages_raw(limit: int = Query(0, ge=0), before: Optional[str] = None,
+                                username: str = Depends(get_current_username)):
+    validate_cursor(before)
+
+    async def stream_messages():
+        yield b"["
+        separator = b""
+        async for message in iter_raw_messages(username, limit, before):
+            message["_id"] = str(message["_id"])
+            message["createdAt"] = message["createdAt"].isoformat()
+            yield separator + json.dumps(message).encode()
+            separator = b","
+        yield b"]"
+
+    return StreamingResponse(stream_messages(), media_type="application/json")
+
+
 @app.get("/user/last_messages/{n}")
-async def get_last_messages_n(n: int, user: User = Depends(get_current_user)):
-    return {"messages": await get_last_n_messages(user.username, n)}
+async def get_last_messages_n(n: int, username: str = Depends(get_current_username)):
+    return {"messages": await get_last_n_messages(username, n)}
 
 
 @app.get("/user/last_messages/")
-async def get_last_messages(user: User = Depends(get_current_user)):
-    return {"messages": await get_all_messages_by_username(user.username)}
+async def get_last_messages(limit: int = Query(0, ge=0), before: Optional[str] = None,
+                            username: str = Depends(get_current_username)):
+    validate_cursor(before)
+    messages = await get_messages_by_username(username, limit=limit, before=before)
+    next_before = None
+    if limit and len(messages) == limit:
+        next_before = encode_message_cursor(messages[-1].createdAt, messages[-1].messageId)
+    return {"messages": messages, "next_before": next_before}
+
+
+@app.get("/user/recall")
+async def recall(query: str, top_k: int = user_memory_settings.TOP_K, username: str = Depends(get_current_username)):
+    if user_message_indexer is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message recall is not enabled")
+    return {"messages": await recall_user_messages(query, username, top_k)}
 
 
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
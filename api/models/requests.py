@@ -1,3 +1,5 @@
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -13,3 +15,7 @@ class RegisterRequest(BaseModel):
 
 class ProcessRequest(BaseModel):
     input_text: str
+
+
+class BatchProcessRequest(BaseModel):
+    inputs: List[str]
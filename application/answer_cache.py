@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from core.cache import TTLCache
+
+
+class _CachedAnswer:
+    def __init__(self, title: str, vector: np.ndarray, answer: str, expires_at: Optional[float]):
+        self.title = title
+        self.vector = vector
+        self.answer = answer
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    def __init__(self, threshold: float, maxsize: int, ttl: float = None):
+        """
+        Caches assistant answers and serves them for prompts with a near-identical embedding.
+
+        Answers are only shared between prompts routed to the same source document. Entries are evicted
+        least-recently-used first, expire after the TTL, and are dropped when their document changes.
+
+        Args:
+            threshold (float): Minimum cosine similarity between prompt embeddings for a hit.
+            maxsize (int): Maximum number of cached answers.
+            ttl (float): Seconds an answer stays valid, or None for no expiry.
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._documents = {}
+        self._matrices = {}
+        self._last_documents = TTLCache(maxsize, ttl)
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def history_is_irrelevant(self, user_name: str, title: str, has_history: bool) -> bool:
+        """
+        Decides whether an answer for this turn can ignore the conversation history.
+
+        History is irrelevant when there is none, or when the user's previous turn was routed to another document.
+
+        Args:
+            user_name (str): The username.
+            title (str): The document the current prompt was routed to.
+            has_history (bool): Whether the user has earlier turns in the prompt history.
+
+        Returns:
+            bool: True if a cached answer may be served and the fresh answer may be cached.
+        """
+        if not has_history:
+            return True
+        last_title = self._last_documents.get(user_name)
+        return last_title is not None and last_title != title
+
+    def note_route(self, user_name: str, title: str):
+        """
+        Remembers which document the user's latest turn was routed to.
+        """
+        self._last_documents.set(user_name, title)
+
+    def lookup(self, title: str, vector: list) -> Optional[str]:
+        """
+        Finds a cached answer for a semantically equivalent prompt about the same document.
+
+        Args:
+            title (str): The document the prompt was routed to.
+            vector (list): The prompt embedding.
+
+        Returns:
+            str: The cached answer, or None on a miss.
+        """
+        query = _unit(vector)
+        with self._lock:
+            keys, matrix = self._document_matrix(title)
+            if keys:
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self._entries[keys[best]].answer
+            self.misses += 1
+            return None
+
+    def store(self, title: str, vector: list, answer: str):
+        """
+        Caches the answer given for a prompt routed to a document.
+
+        Args:
+            title (str): The document the prompt was routed to.
+            vector (list): The prompt embedding.
+            answer (str): The assistant answer.
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            key = self._next_key
+            self._next_key += 1
+            self._entries[key] = _CachedAnswer(title, _unit(vector), answer, expires_at)
+            self._documents.setdefault(title, []).append(key)
+            self._matrices.pop(title, None)
+            while len(self._entries) > self.maxsize:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._forget(evicted_key, evicted.title)
+
+    def invalidate_document(self, title: str):
+        """
+        Drops every cached answer generated from a document.
+
+        Args:
+            title (str): The title of the changed document.
+        """
+        with self._lock:
+            for key in self._documents.pop(title, []):
+                self._entries.pop(key, None)
+            self._matrices.pop(title, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def _forget(self, key: int, title: str):
+        keys = self._documents.get(title)
+        if keys is not None:
+            keys.remove(key)
+            if not keys:
+                del self._documents[title]
+        self._matrices.pop(title, None)
+
+    def _document_matrix(self, title: str):
+        now = time.monotonic()
+        for key in list(self._documents.get(title, [])):
+            entry = self._entries[key]
+            if entry.expires_at is not None and entry.expires_at <= now:
+                del self._entries[key]
+                self._forget(key, title)
+        if title not in self._matrices:
+            keys = list(self._documents.get(title, []))
+            matrix = np.stack([self._entries[key].vector for key in keys]) if keys else None
+            self._matrices[title] = (keys, matrix)
+        return self._matrices[title]
+
+
+def _unit(vector: list) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
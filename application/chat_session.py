@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from application.langchain_lib import stream_user_prompt, remember_turn, conversation_memory, index_user_message
+from db.models.message import Message
+from db.repositories.memory_repository import get_conversation_memory
+from db.repositories.user_repository import create_message, get_last_n_messages
+
+logger = logging.getLogger(__name__)
+
+# Passage lists a session keeps; consecutive turns usually route to the same few documents
+PASSAGE_CACHE_SIZE = 8
+# Turns without a summary carry the same two messages the HTTP endpoints load
+HISTORY_MESSAGES = 2
+
+
+class ChatSession:
+    def __init__(self, username: str):
+        """
+        Conversation state of one chat connection.
+
+        The summary, the recent messages and the passages of recently routed documents are kept in memory, so a
+        turn needs no database reads. Messages are stored in order by a background task.
+
+        Args:
+            username (str): The authenticated user.
+        """
+        self.username = username
+        self.summary = ""
+        self.messages: List[Message] = []
+        self.passages = {}
+        self._pending: asyncio.Queue = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
+
+    async def open(self):
+        """
+        Loads the user's history once and starts persisting messages.
+        """
+        if conversation_memory is not None:
+            self.summary, self.messages = await conversation_memory.load(self.username)
+        else:
+            self.messages = await get_last_n_messages(self.username, HISTORY_MESSAGES)
+        self._writer = asyncio.create_task(self._persist())
+
+    def _history(self) -> Tuple[str, List[Message]]:
+        if conversation_memory is None:
+            return "", self.messages[:HISTORY_MESSAGES]
+        return self.summary, list(self.messages)
+
+    def _kept_messages(self) -> int:
+        if conversation_memory is None:
+            return HISTORY_MESSAGES
+        return conversation_memory.recent_messages + conversation_memory.fold_batch
+
+    def _append(self, text: str, is_user: bool) -> Message:
+        now = datetime.utcnow()
+        # Mongo keeps milliseconds, so in-memory timestamps compare equal to the stored ones
+        created_at = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        message = Message(sender=self.username, text=text, is_user=is_user, createdAt=created_at)
+        self.messages.insert(0, message)
+        del self.messages[self._kept_messages():]
+        self._pending.put_nowait(message)
+        return message
+
+    async def stream_turn(self, prompt: str) -> AsyncIterator[dict]:
+        """
+        Answers one prompt from the in-memory state, streaming the reply.
+
+        Yields:
+            dict: First {"source": ...}, then {"token": ...} for each chunk of the response.
+
+        Raises:
+            RetrievalTimeoutError: If a retrieval stage takes longer than configured.
+            OverloadedError: If the chat deployment is saturated.
+        """
+        # Like the HTTP endpoints, the history includes the prompt itself, which prompt building skips
+        self._append(prompt, True)
+        history = self._history()
+        reply = []
+        try:
+            async for event in stream_user_prompt(prompt, self.username, history, self.passages):
+                if "token" in event:
+                    reply.append(event["token"])
+                yield event
+        finally:
+            if len(self.passages) > PASSAGE_CACHE_SIZE:
+                self.passages.pop(next(iter(self.passages)))
+            if reply:
+                self._append("".join(reply), False)
+                self._pending.put_nowait(None)
+
+    async def _persist(self):
+        while True:
+            message = await self._pending.get()
+            try:
+                if message is None:
+                    # A turn has been stored completely
+                    remember_turn(self.username)
+                    if conversation_memory is not None:
+                        await self._refresh_summary()
+                else:
+                    message_id = await create_message(self.username, message.text, message.is_user,
+                                                      message.createdAt)
+                    if message.is_user:
+                        index_user_message(self.username, message_id, message.text)
+            except Exception:
+                logger.exception("Failed to store a chat message of %s", self.username)
+            finally:
+                self._pending.task_done()
+
+    async def _refresh_summary(self):
+        # Picks up the summary folded after an earlier turn and drops the messages it covers
+        memory = await get_conversation_memory(self.username)
+        if memory is None:
+            return
+        self.summary = memory.summary
+        if memory.summarized_until is not None:
+            self.messages = [message for message in self.messages if message.createdAt > memory.summarized_until]
+
+    async def close(self):
+        """
+        Waits for the remaining messages to be stored.
+        """
+        if self._writer is None:
+            return
+        await self._pending.join()
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from db.models.message import Message
+from db.repositories.memory_repository import get_conversation_memory, save_conversation_memory
+from db.repositories.user_repository import get_last_n_messages, get_messages_since, join_messages
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryMemory:
+    def __init__(self, summarize: Callable[[str, List[str]], Awaitable[str]], recent_messages: int, fold_batch: int,
+                 max_fold: int):
+        """
+        Keeps a rolling summary per user so the prompt carries a fixed amount of history.
+
+        Messages older than the most recent ones are folded into the summary in the background after each turn.
+
+        Args:
+            summarize: Coroutine function taking the current summary and the new history lines, returning the
+                updated summary.
+            recent_messages (int): Number of newest messages kept verbatim instead of summarized.
+            fold_batch (int): Minimum number of messages folded at once, so summaries are not rewritten every turn.
+            max_fold (int): Maximum number of messages folded by one update.
+        """
+        self.summarize = summarize
+        self.recent_messages = recent_messages
+        self.fold_batch = fold_batch
+        self.max_fold = max_fold
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._dirty = set()
+
+    async def load(self, username: str) -> Tuple[str, List[Message]]:
+        """
+        Loads the summary and the messages it does not cover yet.
+
+        Returns:
+            tuple: The summary ("" if there is none) and the unsummarized messages, newest first. Besides the
+                current prompt, at most recent_messages + fold_batch messages are returned.
+        """
+        memory, messages = await asyncio.gather(
+            get_conversation_memory(username),
+            get_last_n_messages(username, self.recent_messages + self.fold_batch + 1)
+        )
+        if memory is None:
+            return "", messages
+        if memory.summarized_until is not None:
+            messages = [message for message in messages if message.createdAt > memory.summarized_until]
+        return memory.summary, messages
+
+    def schedule_update(self, username: str):
+        """
+        Folds the user's older messages into the summary in the background.
+        """
+        task = self._tasks.get(username)
+        if task is not None and not task.done():
+            self._dirty.add(username)
+            return
+        self._tasks[username] = asyncio.create_task(self._run(username))
+
+    async def _run(self, username: str):
+        try:
+            while True:
+                self._dirty.discard(username)
+                try:
+                    await self.update(username)
+                except Exception:
+                    # The messages stay unsummarized and are picked up by the next update
+                    logger.exception("Failed to update the conversation summary of %s", username)
+                if username not in self._dirty:
+                    break
+        finally:
+            self._tasks.pop(username, None)
+
+    async def update(self, username: str) -> bool:
+        """
+        Folds the user's messages that fell out of the recent window into the summary.
+
+        Returns:
+            bool: Whether the summary changed.
+        """
+        memory = await get_conversation_memory(username)
+        since = memory.summarized_until if memory else None
+        messages = await get_messages_since(username, since, self.max_fold + self.recent_messages)
+        to_fold = messages[:-self.recent_messages] if self.recent_messages else messages
+        if len(to_fold) < self.fold_batch:
+            return False
+        summary = await self.summarize(memory.summary if memory else "",
+                                       [join_messages([message]) for message in to_fold])
+        await save_conversation_memory(username, summary, to_fold[-1].createdAt)
+        return True
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Seconds a write waits for another process holding the SQLite lock before it gives up
+SQLITE_BUSY_TIMEOUT_SECONDS = 1.0
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes text so trivially different prompts share a cache entry.
+
+    Args:
+        text (str): The text to normalize.
+
+    Returns:
+        str: The lower-cased text with whitespace collapsed.
+    """
+    return " ".join(text.lower().split())
+
+
+def embedding_cache_key(text: str, deployment: str) -> str:
+    """
+    Builds the cache key for an embedding.
+
+    Args:
+        text (str): The embedded text.
+        deployment (str): The embedding deployment that produced the vector.
+
+    Returns:
+        str: A SHA-256 hex digest of the deployment and the normalized text.
+    """
+    return hashlib.sha256(f"{deployment}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, deployment: str, maxsize: int, ttl: float = None, path: Optional[str] = None):
+        """
+        Two-tier embedding cache: an in-memory LRU in front of an optional SQLite file.
+
+        The SQLite file may be shared by several worker processes, so it runs in WAL mode and any SQLite error is
+        treated as a miss. The async methods keep its reads and writes off the event loop.
+
+        Args:
+            deployment (str): The embedding deployment, part of every key.
+            maxsize (int): Maximum number of embeddings kept in memory.
+            ttl (float): Seconds an embedding stays in memory, or None for no expiry.
+            path (str): SQLite file for the persistent tier, or None to keep the cache in memory only.
+        """
+        self.deployment = deployment
+        self.memory = TTLCache(maxsize, ttl)
+        self.persistent_hits = 0
+        self.misses = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                db = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+                # Readers never wait for writers, and commits do not fsync the database file each time
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+                db.commit()
+                self._db = db
+            except (OSError, sqlite3.Error):
+                logger.exception("Embedding cache file %s is unavailable, caching in memory only", path)
+
+    def _load(self, keys: List[str]) -> Dict[str, list]:
+        if self._db is None or not keys:
+            return {}
+        try:
+            placeholders = ",".join("?" * len(keys))
+            with self._db_lock:
+                rows = self._db.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})",
+                                        keys).fetchall()
+        except sqlite3.Error:
+            logger.warning("Embedding cache read failed", exc_info=True)
+            return {}
+        return {key: np.frombuffer(blob, dtype=np.float32).tolist() for key, blob in rows}
+
+    def _store(self, key: str, embedding: list):
+        if self._db is None:
+            return
+        blob = np.asarray(embedding, dtype=np.float32).tobytes()
+        try:
+            with self._db_lock:
+                self._db.execute("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)", (key, blob))
+                self._db.commit()
+        except sqlite3.Error:
+            logger.warning("Embedding cache write failed", exc_info=True)
+
+    def _promote(self, key: str, embedding: Optional[list]) -> Optional[list]:
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.memory.set(key, embedding)
+        self.persistent_hits += 1
+        return embedding
+
+    def get(self, text: str) -> Optional[list]:
+        """
+        Looks up the embedding of a text, promoting persistent hits into memory.
+
+        Args:
+            text (str): The text to look up.
+
+        Returns:
+            list: The cached embedding, or None on a miss.
+        """
+        key = embedding_cache_key(text, self.deployment)
+        embedding = self.memory.get(key)
+        if embedding is not None:
+            return embedding
+        return self._promote(key, self._load([key]).get(key))
+
+    async def aget(self, text: str) -> Optional[list]:
+        """
+        Looks up the embedding of a text, reading the SQLite file in a worker thread on a memory miss.
+        """
+        return (await self.aget_many([text]))[0]
+
+    async def aget_many(self, texts: List[str]) -> List[Optional[list]]:
+        """
+        Looks up the embeddings of several texts, reading all memory misses from SQLite in one worker thread call.
+
+        Returns:
+            list: One cached embedding or None per text, in input order.
+        """
+        keys = [embedding_cache_key(text, self.deployment) for text in texts]
+        found = {}
+        for key in keys:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                found[key] = embedding
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing and self._db is not None:
+            stored = await asyncio.to_thread(self._load, missing)
+        else:
+            stored = {}
+        for key in missing:
+            found[key] = self._promote(key, stored.get(key))
+        return [found[key] for key in keys]
+
+    def set(self, text: str, embedding: list):
+        """
+        Stores the embedding of a text in both tiers.
+
+        Args:
+            text (str): The embedded text.
+            embedding (list): The embedding vector.
+        """
+        key = embedding_cache_key(text, self.deployment)
+        self.memory.set(key, embedding)
+        self._store(key, embedding)
+
+    def set_behind(self, text: str, embedding: list):
+        """
+        Stores the embedding in memory right away and writes it to the SQLite file in a worker thread, without
+        waiting for the write. Must be called from the event loop.
+        """
+        key = embedding_cache_key(text, self.deployment)
+        self.memory.set(key, embedding)
+        if self._db is not None:
+            asyncio.get_running_loop().run_in_executor(None, self._store, key, embedding)
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters of the cache.
+
+        Returns:
+            dict: Memory hits, persistent hits, misses and the number of embeddings held in memory.
+        """
+        return {
+            "memory_hits": self.memory.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "memory_size": len(self.memory),
+        }
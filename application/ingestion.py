@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from application.langchain_lib import utils, ph, FILES_INDEX, EMBEDDING_DIMENSION, load_document_routes, \
+    files_config
+from application.routing_snapshot import write_snapshot, current_version
+from core.config import snapshot_settings, vector_store_settings
+from db.database import initialize_database
+from db.repositories.text_file_repository import get_text_file_hashes, get_document_routes, \
+    bulk_upsert_text_files, delete_text_chunks, insert_text_chunks, get_routing_corpus
+
+PAGES_PER_TASK = 5
+MAX_CHUNK_CHARS = 2000
+EMBED_BATCH_SIZE = 16
+# Documents parsed ahead of the one being embedded; their passages wait in memory until it is their turn
+PREFETCH_DOCUMENTS = 2
+
+
+def file_content_hash(pdf_path: str) -> str:
+    """
+    Hashes a file without reading it into memory at once.
+
+    Args:
+        pdf_path (str): Path to the file.
+
+    Returns:
+        str: The SHA-256 hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def split_passages(text: str, max_chars: int = MAX_CHUNK_CHARS) -> Iterator[str]:
+    """
+    Splits text into passages of at most max_chars, preferring paragraph boundaries.
+
+    Args:
+        text (str): The text to split.
+        max_chars (int): Maximum passage length in characters.
+
+    Yields:
+        str: Non-empty passages in document order.
+    """
+    current = []
+    current_length = 0
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            yield paragraph[:max_chars]
+            paragraph = paragraph[max_chars:]
+        if not paragraph:
+            continue
+        if current and current_length + len(paragraph) + 1 > max_chars:
+            yield "\n".join(current)
+            current = []
+            current_length = 0
+        current.append(paragraph)
+        current_length += len(paragraph) + 1
+    if current:
+        yield "\n".join(current)
+
+
+def extract_passages(pdf_path: str, start: int, stop: int) -> List[str]:
+    """
+    Extracts the passages of a page range. Runs in a worker process.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        start (int): First page, inclusive.
+        stop (int): Last page, exclusive.
+
+    Returns:
+        list: The passages of the page range.
+    """
+    with fitz.open(pdf_path) as doc:
+        text = "\n\n".join(doc[page_num].get_text() for page_num in range(start, stop))
+    return list(split_passages(text))
+
+
+def submit_pdf(executor: ProcessPoolExecutor, pdf_path: str) -> list:
+    """
+    Queues the page ranges of a PDF for extraction.
+
+    Args:
+        executor (ProcessPoolExecutor): The pool parsing the pages.
+        pdf_path (str): Path to the PDF file.
+
+    Returns:
+        list: Futures of the page-range passages, in page order.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    return [executor.submit(extract_passages, pdf_path, start, min(start + PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PAGES_PER_TASK)]
+
+
+def vector_id_for(title: str, position: int) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "-", title.lower()).strip("-")
+    return f"files-{slug}-{position}"
+
+
+async def ingest_pdf(title: str, content_hash: str, futures: list, source: Optional[str],
+                     old_vector_ids: List[str]) -> dict:
+    """
+    Embeds and stores the passages of one PDF as they come out of the process pool.
+
+    Chunks and Pinecone vectors are written a batch at a time. The local vector store rewrites its whole index file
+    on every write, so its vectors are kept as float32 rows and written once per document.
+
+    Args:
+        title (str): The document title.
+        content_hash (str): The hash of the PDF file.
+        futures (list): Futures of the page-range passages, in page order.
+        source (str): The public link to the document, if known.
+        old_vector_ids (list): Vector ids stored for the previous version of the document.
+
+    Returns:
+        dict: The TextFile row to upsert.
+    """
+    await delete_text_chunks(title)
+    vector_ids = []
+    contents = []
+    batch = []
+    local_vectors = []
+    write_per_batch = vector_store_settings.BACKEND != "local"
+
+    async def flush():
+        embeddings = await utils.embeddings.aembed_documents(batch)
+        ids = [vector_id_for(title, len(vector_ids) + offset) for offset in range(len(batch))]
+        await insert_text_chunks([
+            {"_id": id, "title": title, "position": len(vector_ids) + offset, "content": passage}
+            for offset, (id, passage) in enumerate(zip(ids, batch))
+        ])
+        if write_per_batch:
+            await asyncio.to_thread(ph.insert_vectors, FILES_INDEX, list(zip(ids, embeddings)), EMBEDDING_DIMENSION)
+        else:
+            local_vectors.extend(zip(ids, np.asarray(embeddings, dtype=np.float32)))
+        vector_ids.extend(ids)
+        batch.clear()
+
+    for future in futures:
+        for passage in await asyncio.wrap_future(future):
+            contents.append(passage)
+            batch.append(passage)
+            if len(batch) >= EMBED_BATCH_SIZE:
+                await flush()
+    if batch:
+        await flush()
+    if local_vectors:
+        await asyncio.to_thread(ph.insert_vectors, FILES_INDEX, local_vectors, EMBEDDING_DIMENSION)
+
+    stale_ids = sorted(set(old_vector_ids) - set(vector_ids))
+    if stale_ids:
+        await asyncio.to_thread(ph.delete_vectors, FILES_INDEX, stale_ids, EMBEDDING_DIMENSION)
+    return {"title": title, "content": "\n\n".join(contents), "source": source, "content_hash": content_hash,
+            "vector_ids": vector_ids}
+
+
+async def ingest_directory(directory: str, sources: Optional[Dict[str, str]] = None,
+                           workers: Optional[int] = None) -> dict:
+    """
+    Ingests every PDF of a directory into text_files, text_chunks and the files vector index.
+
+    Documents are titled after their file name. Files whose content hash matches the stored TextFile are skipped.
+    Each TextFile is stored, with its hash, as soon as its document is ingested, so an interrupted run resumes after
+    the last finished document and only one document's text is held in memory at a time.
+
+    Args:
+        directory (str): Directory containing the PDF files.
+        sources (dict): Optional public links keyed by document title.
+        workers (int): Number of processes parsing PDF pages. Defaults to the CPU count.
+
+    Returns:
+        dict: The titles that were ingested, the titles that were skipped as unchanged and, with snapshots
+            enabled, the routing snapshot version published afterwards.
+    """
+    sources = sources or {}
+    stored_hashes = await get_text_file_hashes()
+    stored_vector_ids = {route["title"]: route["vector_ids"] for route in await get_document_routes()}
+    pending = []
+    skipped = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.lower().endswith(".pdf"):
+            continue
+        pdf_path = os.path.join(directory, file_name)
+        title = os.path.splitext(file_name)[0]
+        content_hash = await asyncio.to_thread(file_content_hash, pdf_path)
+        if stored_hashes.get(title) == content_hash:
+            skipped.append(title)
+        else:
+            pending.append((title, pdf_path, content_hash))
+
+    ingested = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Parse a few documents ahead so the pool keeps working while earlier ones are embedded
+        queued = deque()
+        remaining = iter(pending)
+        for title, pdf_path, content_hash in islice(remaining, PREFETCH_DOCUMENTS):
+            queued.append((title, content_hash, submit_pdf(executor, pdf_path)))
+        while queued:
+            title, content_hash, futures = queued.popleft()
+            for next_title, pdf_path, next_hash in islice(remaining, 1):
+                queued.append((next_title, next_hash, submit_pdf(executor, pdf_path)))
+            text_file = await ingest_pdf(title, content_hash, futures, sources.get(title),
+                                         stored_vector_ids.get(title, []))
+            await bulk_upsert_text_files([text_file])
+            ingested.append(title)
+    await load_document_routes()
+    result = {"ingested": ingested, "skipped": skipped}
+    if snapshot_settings.ENABLED and (ingested or current_version(snapshot_settings.PATH) is None):
+        result["snapshot"] = await publish_routing_snapshot()
+    return result
+
+
+async def publish_routing_snapshot() -> str:
+    """
+    Publishes the files vector index and the text of every document and chunk as a new shared snapshot.
+
+    Serving workers pick the new version up on their next poll.
+
+    Returns:
+        str: The name of the published version.
+    """
+    text_files, chunks = await get_routing_corpus()
+    ids = list(dict.fromkeys([chunk["_id"] for chunk in chunks] + list(files_config)))
+    response = await asyncio.to_thread(ph.fetch_vectors, FILES_INDEX, ids, EMBEDDING_DIMENSION)
+    vectors = [(id, list(vector["values"])) for id, vector in response["vectors"].items()]
+    return await asyncio.to_thread(write_snapshot, snapshot_settings.PATH, FILES_INDEX, vectors, text_files, chunks,
+                                   snapshot_settings.KEEP_VERSIONS)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Ingest a directory of PDF documents.")
+    parser.add_argument("directory", nargs="?", help="Directory containing the PDF files")
+    parser.add_argument("--sources", help="JSON file mapping document titles to their public links")
+    parser.add_argument("--workers", type=int, default=None, help="Number of PDF parsing processes")
+    parser.add_argument("--snapshot-only", action="store_true",
+                        help="Only publish a routing snapshot of the stored documents")
+    args = parser.parse_args()
+    if not args.directory and not args.snapshot_only:
+        parser.error("a directory is required unless --snapshot-only is given")
+
+    sources = None
+    if args.sources:
+        with open(args.sources) as f:
+            sources = json.load(f)
+    await initialize_database()
+    if args.snapshot_only:
+        print(json.dumps({"snapshot": await publish_routing_snapshot()}, indent=2))
+        return
+    print(json.dumps(await ingest_directory(args.directory, sources, args.workers), indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,30 @@
-import os
-import fitz  # PyMuPDF
-from langchain_core.messages import HumanMessage
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, List, Optional, Tuple
 
-from application.pinecone_lib import PineconeHelper
-from db.repositories.text_file_repository import find_text_by_title
+from langchain_core.messages import AIMessage, HumanMessage
+
+from application.answer_cache import SemanticAnswerCache
+from application.conversation_memory import SummaryMemory
+from application.embedding_cache import EmbeddingCache, normalize_text
+from application.lexical_router import LexicalRouter, combine_matches
+from application import prompt_builder
+from application.prompt_builder import build_prompt, truncate_to_tokens
+from application.routing_snapshot import RoutingSnapshot, current_version
+from application.user_memory import UserMessageIndexer, recall_index_name
+from application.vector_store import create_vector_store
+from core.admission import AdmissionController, OverloadedError
+from core.config import embedding_cache_settings, answer_cache_settings, retrieval_settings, admission_settings, \
+    memory_settings, prompt_settings, azure_openai_settings, startup_settings, snapshot_settings, batch_settings, \
+    user_memory_settings, vector_store_settings, pinecone_settings, require_setting
+from core.metrics import Counter, stage, record_token_usage, cache_requests
+from core.singleflight import SingleFlight
+from db.models.message import Message
+from db.repositories.text_file_repository import find_text_by_title, add_text_file_listener, get_document_routes, \
+    find_text_chunks, get_routing_corpus
 from db.repositories.user_repository import get_last_n_messages, join_messages
 
-# Set environment variables for API keys and endpoints
-os.environ["AZURE_OPENAI_API_KEY"] = "70acd5849bdd4aaaa8560815c4d929de"
-os.environ["AZURE_OPENAI_ENDPOINT"] = "https://uleague-openai.openai.azure.com/"
-os.environ["AZURE_OPENAI_API_VERSION"] = "2024-02-01"
-os.environ["CONNECTION_STRINGS_PINECONE"] = "a89ce7f5-0a4f-4c82-a7c2-5e4046753349"
+logger = logging.getLogger(__name__)
 
 
 def extract_text_from_pdf(pdf_path, chunk_size=5):
@@ -25,6 +38,8 @@ def extract_text_from_pdf(pdf_path, chunk_size=5):
     Returns:
         list: List of text chunks.
     """
+    import fitz  # PyMuPDF
+
     doc = fitz.open(pdf_path)
     text_chunks = []
 
@@ -38,16 +53,39 @@ def extract_text_from_pdf(pdf_path, chunk_size=5):
 
 
 class EmbeddingsUtils:
-    def __init__(self, api_key, endpoint, deployment, api_version):
+    def __init__(self, api_key, endpoint, deployment, api_version, cache=None, admission=None):
         """
-        Initialize Azure OpenAI Embeddings.
+        Initialize Azure OpenAI Embeddings. The client is created on first use.
+
+        Args:
+            cache (EmbeddingCache): Optional cache consulted before calling the embeddings API.
+            admission (AdmissionController): Optional limit on concurrent asynchronous API calls.
         """
-        self.embeddings = AzureOpenAIEmbeddings(
-            openai_api_key=api_key,
-            azure_endpoint=endpoint,
-            deployment=deployment,
-            openai_api_version=api_version
-        )
+        self._client_settings = {"api_key": api_key, "endpoint": endpoint, "deployment": deployment,
+                                 "api_version": api_version}
+        self._embeddings = None
+        self.cache = cache
+        self.admission = admission
+        self._inflight = SingleFlight("embedding")
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            from langchain_openai import AzureOpenAIEmbeddings
+
+            self._embeddings = AzureOpenAIEmbeddings(
+                openai_api_key=require_setting(self._client_settings["api_key"], "AZURE_OPENAI_API_KEY"),
+                azure_endpoint=self._client_settings["endpoint"],
+                deployment=self._client_settings["deployment"],
+                openai_api_version=self._client_settings["api_version"],
+                timeout=azure_openai_settings.REQUEST_TIMEOUT_SECONDS,
+                max_retries=azure_openai_settings.MAX_RETRIES
+            )
+        return self._embeddings
+
+    @embeddings.setter
+    def embeddings(self, embeddings):
+        self._embeddings = embeddings
 
     def process_text_and_get_embeddings(self, text):
         """
@@ -59,30 +97,397 @@ class EmbeddingsUtils:
         Returns:
             list: Embedding result.
         """
+        if self.cache is not None:
+            embedding_result = self.cache.get(text)
+            if embedding_result is not None:
+                return embedding_result
         embedding_result = self.embeddings.embed_query(text)
+        if self.cache is not None:
+            self.cache.set(text, embedding_result)
+        return embedding_result
+
+    async def aprocess_text_and_get_embeddings(self, text):
+        """
+        Process text and get embeddings using Azure OpenAI API without blocking the event loop.
+
+        Concurrent calls for the same normalized text share one API request.
+
+        Args:
+            text (str): Text to process.
+
+        Returns:
+            list: Embedding result.
+        """
+        if self.cache is not None:
+            embedding_result = await self.cache.aget(text)
+            if embedding_result is not None:
+                return embedding_result
+        return await self._inflight.do(normalize_text(text), lambda: self._aembed_and_cache(text))
+
+    async def aprocess_texts_and_get_embeddings(self, texts):
+        """
+        Gets the embeddings of several texts, sending the ones not in the cache in a single API request.
+
+        Args:
+            texts (list): Texts to process.
+
+        Returns:
+            list: One embedding per text, in input order.
+        """
+        unique = {}
+        for text in texts:
+            unique.setdefault(normalize_text(text), text)
+        if self.cache is not None:
+            cached = await self.cache.aget_many(list(unique.values()))
+        else:
+            cached = [None] * len(unique)
+        embeddings = {key: embedding_result for key, embedding_result in zip(unique, cached)
+                      if embedding_result is not None}
+        missing = {key: text for key, text in unique.items() if key not in embeddings}
+        if missing:
+            if self.admission is not None:
+                async with self.admission.slot():
+                    results = await self.embeddings.aembed_documents(list(missing.values()))
+            else:
+                results = await self.embeddings.aembed_documents(list(missing.values()))
+            for (key, text), embedding_result in zip(missing.items(), results):
+                embeddings[key] = embedding_result
+                if self.cache is not None:
+                    self.cache.set_behind(text, embedding_result)
+        return [embeddings[normalize_text(text)] for text in texts]
+
+    async def _aembed_and_cache(self, text):
+        if self.admission is not None:
+            async with self.admission.slot():
+                embedding_result = await self.embeddings.aembed_query(text)
+        else:
+            embedding_result = await self.embeddings.aembed_query(text)
+        if self.cache is not None:
+            self.cache.set_behind(text, embedding_result)
         return embedding_result
 
 
+EMBEDDING_DEPLOYMENT = azure_openai_settings.EMBEDDING_DEPLOYMENT
+CHAT_DEPLOYMENT = azure_openai_settings.CHAT_DEPLOYMENT
+
 # Initialize utilities
 utils = EmbeddingsUtils(
-    api_key=os.environ["AZURE_OPENAI_API_KEY"],
-    endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
-    deployment="emb_model",
-    api_version=os.environ["AZURE_OPENAI_API_VERSION"]
+    api_key=azure_openai_settings.API_KEY,
+    endpoint=azure_openai_settings.ENDPOINT,
+    deployment=EMBEDDING_DEPLOYMENT,
+    api_version=azure_openai_settings.API_VERSION,
+    cache=EmbeddingCache(
+        deployment=EMBEDDING_DEPLOYMENT,
+        maxsize=embedding_cache_settings.MAX_SIZE,
+        ttl=embedding_cache_settings.TTL_SECONDS,
+        path=embedding_cache_settings.PATH
+    ),
+    admission=AdmissionController(
+        EMBEDDING_DEPLOYMENT,
+        max_concurrency=admission_settings.EMBEDDING_MAX_CONCURRENCY,
+        min_concurrency=admission_settings.MIN_CONCURRENCY,
+        max_queue=admission_settings.MAX_QUEUE,
+        queue_timeout=admission_settings.QUEUE_TIMEOUT_SECONDS,
+        target_latency=admission_settings.EMBEDDING_TARGET_LATENCY_SECONDS
+    )
 )
 
-gpt = AzureChatOpenAI(
-    openai_api_version=os.environ["AZURE_OPENAI_API_VERSION"],
-    azure_deployment="gpt3",
-    model_version="0613",
+# Created on first use by get_chat_model(), so importing this module does not load the OpenAI client
+gpt = None
+
+
+def get_chat_model():
+    global gpt
+    if gpt is None:
+        from langchain_openai import AzureChatOpenAI
+
+        gpt = AzureChatOpenAI(
+            openai_api_key=require_setting(azure_openai_settings.API_KEY, "AZURE_OPENAI_API_KEY"),
+            azure_endpoint=azure_openai_settings.ENDPOINT,
+            openai_api_version=azure_openai_settings.API_VERSION,
+            azure_deployment=CHAT_DEPLOYMENT,
+            model_version=azure_openai_settings.CHAT_MODEL_VERSION,
+            timeout=azure_openai_settings.REQUEST_TIMEOUT_SECONDS,
+            max_retries=azure_openai_settings.MAX_RETRIES
+        )
+    return gpt
+
+
+chat_admission = AdmissionController(
+    CHAT_DEPLOYMENT,
+    max_concurrency=admission_settings.CHAT_MAX_CONCURRENCY,
+    min_concurrency=admission_settings.MIN_CONCURRENCY,
+    max_queue=admission_settings.MAX_QUEUE,
+    queue_timeout=admission_settings.QUEUE_TIMEOUT_SECONDS,
+    target_latency=admission_settings.CHAT_TARGET_LATENCY_SECONDS
 )
 
-ph = PineconeHelper()
+ph = create_vector_store()
 
+FILES_INDEX = "files"
+EMBEDDING_DIMENSION = 3072
 
-def get_best_fit(prompt: str):
-    vector = utils.process_text_and_get_embeddings(prompt)
-    score = ph.query_vector("files", vector, 3, 3072)
+answer_cache = None
+if answer_cache_settings.ENABLED:
+    answer_cache = SemanticAnswerCache(
+        threshold=answer_cache_settings.SIMILARITY_THRESHOLD,
+        maxsize=answer_cache_settings.MAX_SIZE,
+        ttl=answer_cache_settings.TTL_SECONDS
+    )
+    add_text_file_listener(answer_cache.invalidate_document)
+
+
+def _cache_samples():
+    stats = utils.cache.stats()
+    samples = [(("embedding", "memory_hit"), stats["memory_hits"]),
+               (("embedding", "persistent_hit"), stats["persistent_hits"]),
+               (("embedding", "miss"), stats["misses"])]
+    if answer_cache is not None:
+        stats = answer_cache.stats()
+        samples += [(("answer", "hit"), stats["hits"]), (("answer", "miss"), stats["misses"])]
+    return samples
+
+
+cache_requests.add_source(_cache_samples)
+
+routing_decisions = Counter("app_routing_total", "Prompts routed by keyword match alone, by vector search, or both.",
+                            ("route",))
+
+lexical_router = None
+_lexical_rebuild: Optional[asyncio.Task] = None
+if retrieval_settings.LEXICAL_ROUTING_ENABLED:
+    lexical_router = LexicalRouter(
+        min_score=retrieval_settings.LEXICAL_MIN_SCORE,
+        min_margin=retrieval_settings.LEXICAL_MIN_MARGIN
+    )
+    add_text_file_listener(lexical_router.mark_stale)
+
+
+# Identical concurrent prompts share routing, passage loading and, without history, the completion
+_routing_flights = SingleFlight("routing")
+_passage_flights = SingleFlight("passages")
+_completion_flights = SingleFlight("completion")
+
+# Vector id -> (title, source) for documents loaded through the ingestion pipeline
+document_routes = {}
+
+# The published routing snapshot this worker serves from, when snapshots are enabled
+shared_snapshot: Optional[RoutingSnapshot] = None
+_snapshot_watcher: Optional[asyncio.Task] = None
+
+
+def _routing_store():
+    return shared_snapshot.vector_store if shared_snapshot is not None else ph
+
+
+async def load_shared_snapshot() -> bool:
+    """
+    Switches to the published routing snapshot if it is newer than the one being served.
+
+    Requests in flight keep the snapshot they started with; the document routes and the keyword index are
+    rebuilt from the new one.
+
+    Returns:
+        bool: Whether a new snapshot was loaded.
+    """
+    global shared_snapshot
+    version = await asyncio.to_thread(current_version, snapshot_settings.PATH)
+    if version is None or (shared_snapshot is not None and shared_snapshot.version == version):
+        return False
+    shared_snapshot = await asyncio.to_thread(RoutingSnapshot, snapshot_settings.PATH, version)
+    await load_document_routes()
+    await load_lexical_index()
+    logger.info("Serving routing snapshot %s", version)
+    return True
+
+
+async def watch_shared_snapshot(poll_interval: float = snapshot_settings.POLL_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(poll_interval)
+        try:
+            await load_shared_snapshot()
+        except Exception:
+            # Keep serving the current snapshot; the next poll tries again
+            logger.exception("Failed to load the routing snapshot")
+
+
+def start_snapshot_watcher():
+    global _snapshot_watcher
+    if snapshot_settings.ENABLED and (_snapshot_watcher is None or _snapshot_watcher.done()):
+        _snapshot_watcher = asyncio.create_task(watch_shared_snapshot())
+
+
+async def stop_snapshot_watcher():
+    global _snapshot_watcher
+    if _snapshot_watcher is not None:
+        _snapshot_watcher.cancel()
+        try:
+            await _snapshot_watcher
+        except asyncio.CancelledError:
+            pass
+        _snapshot_watcher = None
+
+
+async def load_document_routes():
+    """
+    Loads the vector ids of ingested documents so routing can resolve them without a database lookup.
+    """
+    routes = {}
+    snapshot = shared_snapshot
+    for route in snapshot.documents.values() if snapshot is not None else await get_document_routes():
+        for vector_id in route["vector_ids"]:
+            routes[vector_id] = (route["title"], route.get("source"))
+    document_routes.clear()
+    document_routes.update(routes)
+
+
+def _mark_document_routes_stale(title: str = None):
+    """
+    Reloads the document routes in the background after a document changed, e.g. in another process's ingestion
+    run, so the new chunk vectors resolve to their document. Changes arriving during a reload trigger another one.
+    """
+    global _routes_stale, _routes_reload
+    _routes_stale = True
+    if _routes_reload is None or _routes_reload.done():
+        _routes_reload = asyncio.create_task(_reload_document_routes())
+
+
+async def _reload_document_routes():
+    global _routes_stale
+    while _routes_stale:
+        _routes_stale = False
+        try:
+            await load_document_routes()
+        except Exception:
+            # The next change, or the next unknown vector id, tries again
+            _routes_stale = True
+            logger.exception("Failed to reload document routes")
+            return
+
+
+_routes_stale = False
+_routes_reload: Optional[asyncio.Task] = None
+add_text_file_listener(_mark_document_routes_stale)
+
+
+async def load_lexical_index():
+    """
+    Builds the keyword routing index from the shared snapshot if one is loaded, otherwise from the database.
+
+    Chunked documents are indexed per chunk. Older documents without chunks are indexed whole under the first
+    vector id that files_config maps to them.
+    """
+    if lexical_router is None:
+        return
+    lexical_router.stale = False
+    snapshot = shared_snapshot
+    if snapshot is not None:
+        units = await asyncio.to_thread(snapshot.chunk_units)
+        titles = list(snapshot.documents)
+        document_text = snapshot.document_text
+    else:
+        text_files, chunks = await get_routing_corpus()
+        units = [(chunk["_id"], chunk["title"], chunk["content"]) for chunk in chunks]
+        contents = {text_file["title"]: text_file["content"] for text_file in text_files}
+        titles = list(contents)
+        document_text = contents.get
+    legacy_ids = {}
+    for vector_id, title in files_config.items():
+        legacy_ids.setdefault(title, vector_id)
+    chunked_titles = {title for _, title, _ in units}
+    units.extend((legacy_ids[title], title, document_text(title))
+                 for title in titles if title not in chunked_titles and title in legacy_ids)
+    await asyncio.to_thread(lexical_router.build, units)
+
+
+async def warm_up():
+    """
+    Prepares everything the first request would otherwise wait for: document routes, the keyword index,
+    the model clients, the tokenizer, the vector index and, if enabled, a connection to the embeddings API.
+
+    With snapshots enabled the routes and the keyword index come from the published snapshot when there is one.
+    Every step runs even if an earlier one failed; whatever did not load is loaded on demand by the first requests.
+
+    Returns:
+        bool: Whether the essential steps, document routes, tokenizer and vector index, succeeded.
+    """
+    async def load_routing_data():
+        if not (snapshot_settings.ENABLED and await load_shared_snapshot()):
+            await load_document_routes()
+            await load_lexical_index()
+
+    async def create_clients():
+        get_chat_model()
+        utils.embeddings
+
+    async def open_recall_index():
+        if user_message_indexer is not None and vector_store_settings.BACKEND == "pinecone":
+            # Recall queries the shared index, which is created here once instead of on a user's first message
+            await asyncio.to_thread(ph.create_user_index, pinecone_settings.SHARED_INDEX, EMBEDDING_DIMENSION)
+            await asyncio.to_thread(ph.preload, pinecone_settings.SHARED_INDEX)
+
+    async def reach_upstream():
+        if startup_settings.WARM_UP_UPSTREAM:
+            await utils.aprocess_text_and_get_embeddings("hello")
+
+    essential = [
+        await _warm_up_step("routing data", load_routing_data()),
+        await _warm_up_step("tokenizer", asyncio.to_thread(prompt_builder.get_encoding)),
+        await _warm_up_step("vector index", asyncio.to_thread(_routing_store().preload, FILES_INDEX)),
+    ]
+    await _warm_up_step("model clients", create_clients())
+    await _warm_up_step("recall index", open_recall_index())
+    await _warm_up_step("embeddings API", reach_upstream())
+    return all(essential)
+
+
+async def _warm_up_step(name: str, step: Awaitable) -> bool:
+    try:
+        await step
+        return True
+    except Exception:
+        logger.exception("Warm-up step '%s' failed", name)
+        return False
+
+
+def _refresh_lexical_index():
+    global _lexical_rebuild
+    if lexical_router.stale and (_lexical_rebuild is None or _lexical_rebuild.done()):
+        # Keep routing with the previous index while the new one is built
+        _lexical_rebuild = asyncio.create_task(load_lexical_index())
+
+
+def resolve_document(vector_id: str):
+    """
+    Maps a vector id to the title and source link of its document.
+
+    Args:
+        vector_id (str): The id of the matched vector.
+
+    Returns:
+        tuple: The document title and source link, or (None, None) if the id is unknown.
+    """
+    if vector_id in document_routes:
+        return document_routes[vector_id]
+    if _routes_stale and vector_id not in files_config:
+        _mark_document_routes_stale()
+    return files_config.get(vector_id), sources.get(vector_id)
+
+
+class RetrievalTimeoutError(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"Retrieval stage '{stage}' timed out")
+        self.stage = stage
+
+
+async def _run_stage(stage: str, awaitable, timeout: float):
+    try:
+        return await asyncio.wait_for(awaitable, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise RetrievalTimeoutError(stage)
+
+
+def _best_match_id(score) -> str:
     highest_scoring_match_id = ""
     highest_scoring_match = None
     for match in score.matches:
@@ -93,51 +498,238 @@ def get_best_fit(prompt: str):
     return highest_scoring_match_id
 
 
+def get_best_fit(prompt: str):
+    return get_best_fit_for_vector(utils.process_text_and_get_embeddings(prompt))
+
+
+def get_best_fit_for_vector(vector: list):
+    return _best_match_id(_routing_store().query_vector(FILES_INDEX, vector, 3, EMBEDDING_DIMENSION))
+
+
+async def aget_best_matches(prompt: str, top_k: int = retrieval_settings.TOP_K):
+    """
+    Embeds the prompt and finds the closest passage vectors, each step bounded by its stage timeout.
+
+    Concurrent calls for the same normalized prompt share the work. The returned objects are shared and must not be
+    modified.
+
+    Args:
+        prompt (str): The user's prompt.
+        top_k (int): The number of passages to retrieve.
+
+    Returns:
+        tuple: The prompt embedding and the matches, best first.
+
+    Raises:
+        RetrievalTimeoutError: If embedding or the vector query takes longer than configured.
+    """
+    return await _routing_flights.do((normalize_text(prompt), top_k), lambda: _find_best_matches(prompt, top_k))
+
+
+async def _find_best_matches(prompt: str, top_k: int):
+    with stage("embedding"):
+        vector = await _run_stage("embedding", utils.aprocess_text_and_get_embeddings(prompt),
+                                  retrieval_settings.EMBEDDING_TIMEOUT_SECONDS)
+    with stage("vector_query"):
+        score = await _run_stage("vector_query",
+                                 _routing_store().aquery_vector(FILES_INDEX, vector, top_k, EMBEDDING_DIMENSION),
+                                 retrieval_settings.VECTOR_QUERY_TIMEOUT_SECONDS)
+    return vector, sorted(score.matches, key=lambda match: match['score'], reverse=True)
+
+
+async def aroute_prompt(prompt: str, top_k: int = retrieval_settings.TOP_K):
+    """
+    Finds the passages for a prompt, skipping the embedding call when a keyword identifies the document.
+
+    Prompts whose keyword match is ambiguous go through vector search, and both scores are combined.
+
+    Args:
+        prompt (str): The user's prompt.
+        top_k (int): The number of passages to retrieve.
+
+    Returns:
+        tuple: The prompt embedding (None if it was not needed) and the matches, best first.
+
+    Raises:
+        RetrievalTimeoutError: If embedding or the vector query takes longer than configured.
+    """
+    if lexical_router is None:
+        return await aget_best_matches(prompt, top_k)
+    _refresh_lexical_index()
+    with stage("lexical_route"):
+        lexical_matches, lexical_scores, confident = lexical_router.route(prompt, top_k)
+    if confident:
+        routing_decisions.inc(route="lexical")
+        return None, lexical_matches
+    vector, matches = await aget_best_matches(prompt, top_k)
+    if not lexical_scores:
+        routing_decisions.inc(route="vector")
+        return vector, matches
+    routing_decisions.inc(route="hybrid")
+    return vector, combine_matches(matches, lexical_scores, retrieval_settings.HYBRID_VECTOR_WEIGHT, top_k)
+
+
+async def aget_best_fit(prompt: str):
+    """
+    Embeds the prompt and finds the best matching document vector.
+
+    Returns:
+        tuple: The prompt embedding and the id of the best matching vector ("" if there is none).
+    """
+    vector, matches = await aget_best_matches(prompt, 3)
+    return vector, matches[0]["id"] if matches else ""
+
+
+async def load_passages(matches: list) -> List[str]:
+    """
+    Loads the text behind the matched vectors.
+
+    Ingested vectors map to their passage in text_chunks. Older vectors that only identify a document
+    map to the whole TextFile, included once per document. Text in the shared snapshot is read from there;
+    the rest comes from the database.
+
+    Args:
+        matches (list): Vector matches, best first.
+
+    Returns:
+        list: The passages, best first.
+    """
+    return (await load_passages_batch([matches]))[0]
+
+
+async def load_passages_batch(match_lists: List[list]) -> List[List[str]]:
+    """
+    Loads the passages of several match lists, fetching each chunk and each document once.
+
+    Args:
+        match_lists (list): Vector matches per prompt, best first.
+
+    Returns:
+        list: The passages per prompt, best first.
+    """
+    snapshot = shared_snapshot
+    ids = list(dict.fromkeys(match["id"] for matches in match_lists for match in matches))
+    chunks = {}
+    if snapshot is not None:
+        chunks = {id: chunk for id in ids if (chunk := snapshot.chunk(id)) is not None}
+        ids = [id for id in ids if id not in chunks]
+    if ids:
+        chunks.update(await find_text_chunks(ids))
+    titles = [title for title in dict.fromkeys(resolve_document(id)[0] for id in ids if id not in chunks) if title]
+    documents = dict(zip(titles, await asyncio.gather(*(_document_text(title, snapshot) for title in titles))))
+    passages_per_prompt = []
+    for matches in match_lists:
+        passages = []
+        seen_titles = set()
+        for match in matches:
+            if match["id"] in chunks:
+                passages.append(chunks[match["id"]]["content"])
+                continue
+            title, _ = resolve_document(match["id"])
+            if title and title not in seen_titles:
+                seen_titles.add(title)
+                if documents.get(title) is not None:
+                    passages.append(documents[title])
+        passages_per_prompt.append(passages)
+    return passages_per_prompt
+
+
+async def _document_text(title: str, snapshot: Optional[RoutingSnapshot]) -> Optional[str]:
+    content = snapshot.document_text(title) if snapshot is not None else None
+    if content is None:
+        text_file = await find_text_by_title(title)
+        content = text_file.content if text_file else None
+    return content
+
+
+async def _get_history(user_name: str) -> Tuple[str, List[Message]]:
+    """
+    Loads the conversation summary and the recent messages, newest first.
+    """
+    if conversation_memory is not None:
+        history = conversation_memory.load(user_name)
+    else:
+        history = _summaryless(get_last_n_messages(user_name, 2))
+    try:
+        with stage("history"):
+            return await asyncio.wait_for(history, timeout=retrieval_settings.HISTORY_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        # History only adds context, so answer without it rather than failing the turn
+        return "", []
+
+
+async def _summaryless(messages: Awaitable[List[Message]]) -> Tuple[str, List[Message]]:
+    return "", await messages
+
+
 def get_best_fit_user_idx(prompt: str, username):
     vector = utils.process_text_and_get_embeddings(prompt)
-    score = ph.query_vector("username", vector, 3, 3072)
-    highest_scoring_match_id = ""
-    highest_scoring_match = None
-    for match in score.matches:
-        # If highest_scoring_match is None or current match's score is higher, update it
-        if highest_scoring_match is None or match['score'] > highest_scoring_match['score']:
-            highest_scoring_match = match
-            highest_scoring_match_id = match["id"]
-    return highest_scoring_match_id
+    return _best_match_id(ph.query_vector(recall_index_name(username), vector, 3, EMBEDDING_DIMENSION))
 
 
-def truncate_history(conversation_history, max_tokens=4096):
-    total_tokens = 0
-    truncated_history = []
-    for message in reversed(conversation_history):
-        message_tokens = len(message.split()) + 1
-        total_tokens += message_tokens
-        if total_tokens > max_tokens:
-            break
-        truncated_history.insert(0, message)
-    return truncated_history
+user_message_indexer = None
+if user_memory_settings.ENABLED:
+    user_message_indexer = UserMessageIndexer(
+        utils.aprocess_texts_and_get_embeddings,
+        ph,
+        dimension=EMBEDDING_DIMENSION,
+        max_batch=user_memory_settings.MAX_BATCH,
+        flush_interval=user_memory_settings.FLUSH_INTERVAL_SECONDS,
+        max_pending=user_memory_settings.MAX_PENDING
+    )
 
 
-async def process_user_prompt(prompt: str, user_name: str):
-    history_revrsed = truncate_history(join_messages(await get_last_n_messages(user_name, 2)))
-    best_fit = get_best_fit(prompt)
-    if best_fit is None:
-        assistant_reply = "I'm sorry, I don't have the information you need. Please contact our live support for further assistance."
-        return {"result": assistant_reply, "source": None}
-    file = files_config[best_fit]
-    source = sources[best_fit]
-    context_f = (await find_text_by_title(file)).content
+def index_user_message(user_name: str, message_id: str, text: str):
     """
-    Process the user's prompt and generate a response using GPT-3.
+    Queues a stored user message for embedding, so it can be recalled later.
+    """
+    if user_message_indexer is not None:
+        user_message_indexer.enqueue(user_name, message_id, text)
+
+
+async def recall_user_messages(prompt: str, user_name: str, top_k: int = user_memory_settings.TOP_K) -> List[dict]:
+    """
+    Finds the user's past messages most similar to the prompt with a single query of their index.
 
     Args:
-        prompt (str): The user's prompt.
+        prompt (str): The text to compare against.
         user_name (str): The username.
+        top_k (int): The number of messages to return.
 
     Returns:
-        str: The generated response.
+        list: The messages as {"messageId", "text", "score"}, most similar first.
+
+    Raises:
+        RetrievalTimeoutError: If embedding or the vector query takes longer than configured.
     """
-    prompt_template = """ Prompt Template:
+    with stage("embedding"):
+        vector = await _run_stage("embedding", utils.aprocess_text_and_get_embeddings(prompt),
+                                  retrieval_settings.EMBEDDING_TIMEOUT_SECONDS)
+    with stage("vector_query"):
+        result = await _run_stage("vector_query",
+                                  ph.aquery_vector(recall_index_name(user_name), vector, top_k, EMBEDDING_DIMENSION),
+                                  retrieval_settings.VECTOR_QUERY_TIMEOUT_SECONDS)
+    return [{"messageId": match["id"], "text": (match.get("metadata") or {}).get("original_data"),
+             "score": match["score"]} for match in result.matches]
+
+
+def prior_messages(messages: List[Message], prompt: str) -> List[Message]:
+    """
+    Drops the current prompt from the newest-first history, since it is stored before processing.
+    """
+    if messages and messages[0].is_user and messages[0].text == prompt:
+        return messages[1:]
+    return messages
+
+
+def has_prior_turns(messages: List[Message], prompt: str) -> bool:
+    """
+    Tells whether the history holds anything besides the current prompt.
+    """
+    return len(prior_messages(messages, prompt)) > 0
+
+
+PROMPT_TEMPLATE = """ Prompt Template:
 You are a customer support representative at Jawwal, a leading mobile network provider. Your role involves assisting customers with their inquiries, providing accurate and helpful responses. Maintain a friendly, professional, and empathetic tone throughout the interaction. Use your knowledge and resources effectively to address customer concerns. If additional information is needed, request it politely from the customer. Aim to make every customer feel valued and understood.
 
 - Keep your response concise, aiming for no more than 30 words.
@@ -155,12 +747,313 @@ Your Task:
 Provide a clear, concise, and relevant response based on the customer’s question and the provided context and history.
 """
 
-    formatted_prompt = prompt_template.format(user_prompt=prompt, conversation_history=history_revrsed,
-                                              context=context_f)
-    message = HumanMessage(content=formatted_prompt)
+NO_MATCH_REPLY = "I'm sorry, I don't have the information you need. Please contact our live support for further assistance."
+
+
+async def prepare_user_prompt(prompt: str, user_name: str, history: Optional[Tuple[str, List[Message]]] = None,
+                              passage_cache: Optional[dict] = None) -> dict:
+    """
+    Runs retrieval for the user's prompt and builds the completion request.
+
+    Args:
+        prompt (str): The user's prompt.
+        user_name (str): The username.
+        history (tuple): The summary and recent messages (newest first) when the caller keeps them in memory;
+            otherwise they are loaded from the database.
+        passage_cache (dict): Passages keyed by matched vector ids, reused across the turns of one session.
+
+    Returns:
+        dict: The source link plus either a ready "answer" (no match or cache hit) or the "message" to send to GPT.
+
+    Raises:
+        RetrievalTimeoutError: If a retrieval stage takes longer than configured.
+    """
+    if history is None:
+        (summary, messages), (vector, matches) = await asyncio.gather(_get_history(user_name), aroute_prompt(prompt))
+    else:
+        (summary, messages), (vector, matches) = history, await aroute_prompt(prompt)
+    file, source = resolve_document(matches[0]["id"]) if matches else (None, None)
+    if not file:
+        return {"answer": NO_MATCH_REPLY, "message": None, "source": None, "cacheable": False, "shareable": False}
+    has_history = bool(summary) or has_prior_turns(messages, prompt)
+    prepared = {"answer": None, "message": None, "source": source, "file": file, "vector": vector,
+                "cacheable": False, "shareable": not has_history}
+    if answer_cache is not None:
+        # Keyword-routed prompts have no embedding to compare cached answers against
+        prepared["cacheable"] = vector is not None and answer_cache.history_is_irrelevant(user_name, file, has_history)
+        answer_cache.note_route(user_name, file)
+        if prepared["cacheable"]:
+            prepared["answer"] = answer_cache.lookup(file, vector)
+            if prepared["answer"] is not None:
+                return prepared
+    match_ids = tuple(match["id"] for match in matches)
+    passages = passage_cache.get(match_ids) if passage_cache is not None else None
+    if passages is None:
+        with stage("document"):
+            passages = await _run_stage("document", _passage_flights.do(match_ids, lambda: load_passages(matches)),
+                                        retrieval_settings.DOCUMENT_TIMEOUT_SECONDS)
+        if passage_cache is not None:
+            passage_cache[match_ids] = passages
+    history = [join_messages([message]) for message in reversed(prior_messages(messages, prompt))]
+    formatted_prompt = build_prompt(PROMPT_TEMPLATE, prompt, passages, history, summary)
+    prepared["message"] = HumanMessage(content=formatted_prompt)
+    return prepared
+
+
+async def _complete(message: HumanMessage) -> AIMessage:
+    async with chat_admission.slot():
+        with stage("completion"):
+            result = await get_chat_model().ainvoke([message])
+    record_token_usage(CHAT_DEPLOYMENT, result)
+    return result
+
+
+SUMMARY_PROMPT = """You keep notes on a conversation between a customer and a Jawwal customer support representative.
+Update the summary with the new lines. Keep facts about the customer, their plans and devices, what was already answered and any unresolved issue. Drop greetings and small talk. Write at most {max_words} words.
+
+Current summary: {summary}
+
+New lines:
+{lines}
+
+Updated summary:"""
+
+
+async def _summarize(summary: str, lines: List[str]) -> str:
+    message = HumanMessage(content=SUMMARY_PROMPT.format(summary=summary or "(empty)", lines="\n".join(lines),
+                                                         max_words=prompt_settings.SUMMARY_MAX_TOKENS * 3 // 4))
+    async with chat_admission.slot():
+        with stage("summary"):
+            result = await get_chat_model().ainvoke([message])
+    record_token_usage(CHAT_DEPLOYMENT, result)
+    return truncate_to_tokens(result.content.strip(), prompt_settings.SUMMARY_MAX_TOKENS)
+
+
+conversation_memory = None
+if memory_settings.SUMMARY_ENABLED:
+    conversation_memory = SummaryMemory(
+        _summarize,
+        recent_messages=memory_settings.RECENT_MESSAGES,
+        fold_batch=memory_settings.FOLD_BATCH,
+        max_fold=memory_settings.MAX_FOLD
+    )
+
+
+def remember_turn(user_name: str):
+    """
+    Schedules folding the user's older messages into their summary once a turn has been stored.
+    """
+    if conversation_memory is not None:
+        conversation_memory.schedule_update(user_name)
+
+
+def _remember_answer(prepared: dict, answer: str):
+    if prepared["cacheable"]:
+        answer_cache.store(prepared["file"], prepared["vector"], answer)
+
+
+async def process_user_prompt(prompt: str, user_name: str):
+    """
+    Process the user's prompt and generate a response using GPT-3.
+
+    Args:
+        prompt (str): The user's prompt.
+        user_name (str): The username.
+
+    Returns:
+        dict: The generated response message and the source link.
+    """
+    prepared = await prepare_user_prompt(prompt, user_name)
+    if prepared["answer"] is not None:
+        return {"result": AIMessage(content=prepared["answer"]), "source": prepared["source"]}
+
+    message = prepared["message"]
+    if prepared["shareable"]:
+        # Without history the prompt is fully determined by the question and passages, so identical requests match
+        result = await _completion_flights.do(message.content, lambda: _complete(message))
+    else:
+        result = await _complete(message)
+    _remember_answer(prepared, result.content)
+    return {"result": result, "source": prepared["source"]}
+
+
+async def stream_user_prompt(prompt: str, user_name: str, history: Optional[Tuple[str, List[Message]]] = None,
+                             passage_cache: Optional[dict] = None) -> AsyncIterator[dict]:
+    """
+    Process the user's prompt and stream the response as it is generated.
+
+    Args:
+        prompt (str): The user's prompt.
+        user_name (str): The username.
+        history (tuple): The summary and recent messages, newest first, if already in memory.
+        passage_cache (dict): Passages keyed by matched vector ids, reused across the turns of one session.
+
+    Yields:
+        dict: First {"source": ...}, then {"token": ...} for each chunk of the response.
+    """
+    prepared = await prepare_user_prompt(prompt, user_name, history, passage_cache)
+    yield {"source": prepared["source"]}
+    if prepared["answer"] is not None:
+        yield {"token": prepared["answer"]}
+        return
+
+    chunks = []
+    pending: asyncio.Queue = asyncio.Queue()
+    reader = asyncio.create_task(_read_completion_stream(prepared["message"], pending))
+    try:
+        while True:
+            content = await pending.get()
+            if content is None:
+                break
+            if isinstance(content, Exception):
+                raise content
+            chunks.append(content)
+            yield {"token": content}
+    finally:
+        # Stops the upstream read when the client goes away before the reply is complete
+        reader.cancel()
+    _remember_answer(prepared, "".join(chunks))
+
+
+async def _read_completion_stream(message: HumanMessage, pending: asyncio.Queue):
+    """
+    Reads a streamed completion into the queue, ending with None or the exception that stopped it.
+
+    The admission slot is held only while the deployment is generating, so clients reading the reply slowly
+    neither keep a slot nor count as upstream latency.
+    """
+    try:
+        async with chat_admission.slot():
+            with stage("completion"):
+                async for chunk in get_chat_model().astream([message]):
+                    # Usage is only reported on the final chunk, and only when the deployment includes it
+                    record_token_usage(CHAT_DEPLOYMENT, chunk)
+                    if chunk.content:
+                        pending.put_nowait(chunk.content)
+    except Exception as exc:
+        pending.put_nowait(exc)
+        return
+    pending.put_nowait(None)
+
+
+async def _route_prompts(prompts: List[str], top_k: int) -> list:
+    """
+    Routes several prompts with one embedding request and one batched vector query.
+
+    Returns:
+        list: Per prompt, the prompt embedding (None if keyword routing sufficed) and the matches, or the exception
+            that stopped its routing, e.g. RetrievalTimeoutError.
+    """
+    lexical = [None] * len(prompts)
+    if lexical_router is not None:
+        _refresh_lexical_index()
+        with stage("lexical_route"):
+            lexical = [lexical_router.route(prompt, top_k) for prompt in prompts]
+    routes = [None] * len(prompts)
+    pending = []
+    for position, routed in enumerate(lexical):
+        if routed is not None and routed[2]:
+            routing_decisions.inc(route="lexical")
+            routes[position] = (None, routed[0])
+        else:
+            pending.append(position)
+    if not pending:
+        return routes
+    try:
+        with stage("embedding"):
+            vectors = await _run_stage("embedding", utils.aprocess_texts_and_get_embeddings(
+                [prompts[position] for position in pending]), retrieval_settings.EMBEDDING_TIMEOUT_SECONDS)
+        with stage("vector_query"):
+            results = await _run_stage("vector_query",
+                                       _routing_store().aquery_vectors(FILES_INDEX, vectors, top_k,
+                                                                       EMBEDDING_DIMENSION),
+                                       retrieval_settings.VECTOR_QUERY_TIMEOUT_SECONDS)
+    except Exception as exc:
+        for position in pending:
+            routes[position] = exc
+        return routes
+    for position, vector, result in zip(pending, vectors, results):
+        matches = sorted(result.matches, key=lambda match: match['score'], reverse=True)
+        lexical_scores = lexical[position][1] if lexical[position] is not None else {}
+        if lexical_scores:
+            routing_decisions.inc(route="hybrid")
+            matches = combine_matches(matches, lexical_scores, retrieval_settings.HYBRID_VECTOR_WEIGHT, top_k)
+        else:
+            routing_decisions.inc(route="vector")
+        routes[position] = (vector, matches)
+    return routes
+
+
+def _prompt_error(exc: Exception) -> dict:
+    if isinstance(exc, OverloadedError):
+        return {"error": str(exc), "status": 503, "retry_after": exc.retry_after}
+    if isinstance(exc, RetrievalTimeoutError):
+        return {"error": str(exc), "status": 504}
+    logger.error("Failed to process a batched prompt", exc_info=exc)
+    return {"error": "Failed to process the prompt", "status": 500}
+
+
+async def process_user_prompts(prompts: List[str], concurrency: int = batch_settings.CONCURRENCY) -> List[dict]:
+    """
+    Answers many independent prompts at once, e.g. for offline jobs.
+
+    All prompts are embedded with one request and routed with one batched vector query, every chunk and document is
+    loaded once, and completions run concurrently. Each prompt is answered without conversation history and
+    nothing is stored in any user's messages. Routing and passage loading are bounded by the retrieval stage
+    timeouts; a stage that times out fails the prompts waiting on it with status 504.
+
+    Args:
+        prompts (list): The prompts.
+        concurrency (int): Maximum number of completions in flight.
+
+    Returns:
+        list: One dict per prompt, in order: the response message and source link, or "error" with an HTTP
+            "status" (and "retry_after" when overloaded) for prompts that failed.
+    """
+    results: List[Optional[dict]] = [None] * len(prompts)
+    pending = []
+    for position, route in enumerate(await _route_prompts(prompts, retrieval_settings.TOP_K)):
+        if isinstance(route, Exception):
+            results[position] = _prompt_error(route)
+            continue
+        vector, matches = route
+        file, source = resolve_document(matches[0]["id"]) if matches else (None, None)
+        if not file:
+            results[position] = {"result": AIMessage(content=NO_MATCH_REPLY), "source": None}
+            continue
+        prepared = {"source": source, "file": file, "vector": vector,
+                    "cacheable": answer_cache is not None and vector is not None}
+        if prepared["cacheable"]:
+            answer = answer_cache.lookup(file, vector)
+            if answer is not None:
+                results[position] = {"result": AIMessage(content=answer), "source": source}
+                continue
+        pending.append((position, matches, prepared))
+
+    try:
+        with stage("document"):
+            passages = await _run_stage("document", load_passages_batch([matches for _, matches, _ in pending]),
+                                        retrieval_settings.DOCUMENT_TIMEOUT_SECONDS)
+    except Exception as exc:
+        for position, _, _ in pending:
+            results[position] = _prompt_error(exc)
+        return results
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def complete(position: int, prompt_passages: List[str], prepared: dict):
+        message = HumanMessage(content=build_prompt(PROMPT_TEMPLATE, prompts[position], prompt_passages, []))
+        try:
+            async with semaphore:
+                result = await _completion_flights.do(message.content, lambda: _complete(message))
+        except Exception as exc:
+            results[position] = _prompt_error(exc)
+            return
+        _remember_answer(prepared, result.content)
+        results[position] = {"result": result, "source": prepared["source"]}
 
-    result = await gpt.ainvoke([message])
-    return {"result": result, "source": source}
+    await asyncio.gather(*(complete(position, prompt_passages, prepared)
+                           for (position, _, prepared), prompt_passages in zip(pending, passages)))
+    return results
 
 
 files_config = {"files-vector-0-0": "ESim", "files-vector-1-1": "Internet Packages",
@@ -0,0 +1,128 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a about an and are as at be but by can could do does for from have how i if in is it its me my of on or our please
+should so that the their them there this to was we what when where which who why will with would you your
+""".split())
+TITLE_WEIGHT = 3
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lower-cased alphanumeric terms, dropping common English stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class _LexicalIndex:
+    def __init__(self, units: List[Tuple[str, str, str]], k1: float, b: float):
+        self.ids = [id for id, _, _ in units]
+        self.titles = [title for _, title, _ in units]
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.lengths = []
+        for position, (_, title, text) in enumerate(units):
+            # Document titles name the topic outright, so their terms count several times over
+            terms = Counter(tokenize(title) * TITLE_WEIGHT + tokenize(text))
+            self.lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, []).append((position, frequency))
+        count = len(units)
+        self.average_length = sum(self.lengths) / count if count else 0.0
+        self.idf = {term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for term, postings in self.postings.items()}
+        self.k1 = k1
+        self.b = b
+
+    def score(self, query: str) -> Dict[int, float]:
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            for position, frequency in self.postings.get(term, ()):
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / self.average_length)
+                scores[position] = scores.get(position, 0.0) + \
+                    self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+        return scores
+
+
+class LexicalRouter:
+    def __init__(self, min_score: float, min_margin: float, k1: float = 1.2, b: float = 0.75):
+        """
+        Routes prompts with BM25 over the document corpus when a keyword identifies the document unambiguously.
+
+        Args:
+            min_score (float): BM25 score the best match needs before it is trusted on its own.
+            min_margin (float): Relative lead the best document needs over the best other document.
+            k1 (float): BM25 term frequency saturation.
+            b (float): BM25 length normalization.
+        """
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.k1 = k1
+        self.b = b
+        self.stale = False
+        self._index: Optional[_LexicalIndex] = None
+
+    def build(self, units: List[Tuple[str, str, str]]):
+        """
+        Replaces the index.
+
+        Args:
+            units (list): (vector id, document title, text) of every routable passage or document.
+        """
+        self._index = _LexicalIndex(units, self.k1, self.b)
+
+    def mark_stale(self, title: str = None):
+        self.stale = True
+
+    def route(self, prompt: str, top_k: int) -> Tuple[List[dict], Dict[str, float], bool]:
+        """
+        Scores the prompt against the index.
+
+        Args:
+            prompt (str): The user's prompt.
+            top_k (int): The number of matches to return.
+
+        Returns:
+            tuple: The best matches (scores relative to the best one), every nonzero score keyed by vector id
+                (also relative to the best one), and whether the best document is a confident choice.
+        """
+        index = self._index
+        if index is None:
+            return [], {}, False
+        ranked = sorted(index.score(prompt).items(), key=lambda item: item[1], reverse=True)
+        if not ranked:
+            return [], {}, False
+        best_position, best_score = ranked[0]
+        best_title = index.titles[best_position]
+        runner_up = next((score for position, score in ranked if index.titles[position] != best_title), 0.0)
+        confident = best_score >= self.min_score and best_score - runner_up >= self.min_margin * best_score
+        scores = {index.ids[position]: score / best_score for position, score in ranked}
+        matches = [{"id": index.ids[position], "score": score / best_score} for position, score in ranked[:top_k]]
+        return matches, scores, confident
+
+    def __len__(self):
+        return len(self._index.ids) if self._index is not None else 0
+
+
+def combine_matches(vector_matches: List[dict], lexical_scores: Dict[str, float], vector_weight: float,
+                    top_k: int) -> List[dict]:
+    """
+    Ranks the union of vector and lexical matches by a weighted sum of both scores.
+
+    Args:
+        vector_matches (list): Vector matches with cosine scores.
+        lexical_scores (dict): Lexical scores keyed by vector id, relative to the best one.
+        vector_weight (float): Weight of the vector score; the lexical score gets the rest.
+        top_k (int): The number of matches to return.
+
+    Returns:
+        list: The combined matches, best first.
+    """
+    combined = {match["id"]: vector_weight * match["score"] for match in vector_matches}
+    for id, score in lexical_scores.items():
+        combined[id] = combined.get(id, 0.0) + (1 - vector_weight) * score
+    ranked = sorted(combined.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [{"id": id, "score": score} for id, score in ranked]
@@ -0,0 +1,289 @@
+import json
+import os
+import threading
+from urllib.parse import quote
+
+import numpy as np
+
+from application.vector_store import QueryResult, VectorStore
+
+
+class _LocalIndex:
+    def __init__(self, ids: list, matrix: np.ndarray, metadata: dict = None):
+        self.ids = ids
+        self.positions = {id: position for position, id in enumerate(ids)}
+        self.matrix = matrix
+        self.metadata = metadata or {}
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, path: str):
+        """
+        Initializes an in-process vector store persisted under the given directory.
+
+        Each index is kept as a contiguous float32 matrix of unit-length rows, so cosine similarity
+        is a single matrix product. Matrices are memory-mapped when loaded from disk.
+
+        Args:
+            path (str): Directory holding the index files.
+        """
+        self.path = path
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _files(self, username: str):
+        # Escaping path separators keeps every name inside the store's directory
+        base = os.path.join(self.path, quote(username, safe=""))
+        return f"{base}.npy", f"{base}.json"
+
+    def _load(self, username: str, dimension: int = None) -> _LocalIndex:
+        index = self._indexes.get(username)
+        if index is not None:
+            return index
+        with self._lock:
+            index = self._indexes.get(username)
+            if index is not None:
+                return index
+            matrix_file, ids_file = self._files(username)
+            if os.path.exists(ids_file):
+                with open(ids_file) as f:
+                    stored = json.load(f)
+                ids, metadata = stored["ids"], stored.get("metadata")
+                matrix = np.load(matrix_file, mmap_mode='r')
+            else:
+                ids, metadata = [], None
+                matrix = np.empty((0, dimension or 0), dtype=np.float32)
+            index = _LocalIndex(ids, matrix, metadata)
+            self._indexes[username] = index
+            return index
+
+    def _save(self, username: str, index: _LocalIndex):
+        os.makedirs(self.path, exist_ok=True)
+        matrix_file, ids_file = self._files(username)
+        with open(f"{matrix_file}.tmp", "wb") as f:
+            np.save(f, index.matrix)
+        with open(f"{ids_file}.tmp", "w") as f:
+            stored = {"ids": index.ids, "dimension": index.matrix.shape[1]}
+            if index.metadata:
+                stored["metadata"] = index.metadata
+            json.dump(stored, f)
+        os.replace(f"{matrix_file}.tmp", matrix_file)
+        os.replace(f"{ids_file}.tmp", ids_file)
+
+    def preload(self, username: str):
+        """
+        Memory-maps the user's index so the first query does not pay for opening it.
+
+        Args:
+            username (str): The username whose index is loaded.
+        """
+        self._load(username)
+
+    def insert_vector(self, username: str, id: str, vector: list, dimension: int):
+        """
+        Inserts or updates a vector in the user's local index.
+
+        Args:
+            username (str): The username whose index is being updated.
+            id (str): The unique identifier for the vector.
+            vector (list): The vector data.
+            dimension (int): The dimension of the vector.
+
+        Raises:
+            ValueError: If the dimension of the vector does not match the specified dimension.
+        """
+        self.insert_vectors(username, [(id, vector)], dimension)
+
+    def insert_vectors(self, username: str, vectors: list, dimension: int):
+        """
+        Inserts or updates several vectors in the user's local index, rewriting the index file once.
+
+        Args:
+            username (str): The username whose index is being updated.
+            vectors (list): (id, values) pairs, or (id, values, metadata) triples.
+            dimension (int): The dimension of the vectors.
+
+        Raises:
+            ValueError: If the dimension of any vector does not match the specified dimension.
+        """
+        if any(len(vector[1]) != dimension for vector in vectors):
+            raise ValueError(f"Vector dimension should be {dimension}")
+        if not vectors:
+            return
+        self._load(username, dimension)
+        rows = _normalize(np.asarray([vector[1] for vector in vectors], dtype=np.float32))
+        with self._lock:
+            index = self._indexes[username]
+            ids = list(index.ids)
+            positions = dict(index.positions)
+            metadata = dict(index.metadata)
+            matrix = np.array(index.matrix, dtype=np.float32).reshape(-1, dimension)
+            new_rows = []
+            for vector, row in zip(vectors, rows):
+                id = vector[0]
+                if len(vector) > 2:
+                    metadata[id] = vector[2]
+                if id in positions and positions[id] < len(matrix):
+                    matrix[positions[id]] = row
+                elif id in positions:
+                    new_rows[positions[id] - len(matrix)] = row
+                else:
+                    positions[id] = len(ids)
+                    ids.append(id)
+                    new_rows.append(row)
+            if new_rows:
+                matrix = np.vstack([matrix, np.asarray(new_rows, dtype=np.float32)])
+            index = _LocalIndex(ids, np.ascontiguousarray(matrix), metadata)
+            self._save(username, index)
+            self._indexes[username] = index
+
+    def query_vector(self, username: str, vector: list, top_k: int, dimension: int):
+        """
+        Queries the user's local index for the most similar vectors by cosine similarity.
+
+        Args:
+            username (str): The username whose index is being queried.
+            vector (list): The query vector.
+            top_k (int): The number of top similar vectors to return.
+            dimension (int): The dimension of the query vector.
+
+        Returns:
+            QueryResult: The matches, best first.
+
+        Raises:
+            ValueError: If the dimension of the vector does not match the specified dimension.
+        """
+        return self.query_vectors(username, [vector], top_k, dimension)[0]
+
+    async def aquery_vector(self, username: str, vector: list, top_k: int, dimension: int):
+        """
+        Queries the user's local index inline; a matrix product over a few rows is cheaper than an executor hop.
+        """
+        return self.query_vector(username, vector, top_k, dimension)
+
+    async def aquery_vectors(self, username: str, vectors: list, top_k: int, dimension: int):
+        """
+        Queries the user's local index inline with one matrix product for all vectors.
+        """
+        return self.query_vectors(username, vectors, top_k, dimension)
+
+    def query_vectors(self, username: str, vectors: list, top_k: int, dimension: int):
+        """
+        Queries the user's local index with several vectors in one matrix product.
+
+        Args:
+            username (str): The username whose index is being queried.
+            vectors (list): The query vectors.
+            top_k (int): The number of top similar vectors to return per query.
+            dimension (int): The dimension of the query vectors.
+
+        Returns:
+            list: One QueryResult per query vector, in input order.
+
+        Raises:
+            ValueError: If the dimension of any vector does not match the specified dimension.
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        if queries.shape[1] != dimension:
+            raise ValueError(f"Vector dimension should be {dimension}")
+        index = self._load(username, dimension)
+        k = min(top_k, len(index.ids))
+        if k <= 0:
+            return [QueryResult(matches=[], namespace="") for _ in vectors]
+        scores = _normalize(queries) @ index.matrix.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            ordered = row_top[np.argsort(-row_scores[row_top])]
+            matches = [{"id": index.ids[i], "score": float(row_scores[i]),
+                        **({"metadata": index.metadata[index.ids[i]]} if index.ids[i] in index.metadata else {})}
+                       for i in ordered]
+            results.append(QueryResult(matches=matches, namespace=""))
+        return results
+
+    def delete_vector(self, username: str, id: str, dimension: int):
+        """
+        Deletes a vector from the user's local index.
+
+        Args:
+            username (str): The username whose index is being updated.
+            id (str): The unique identifier of the vector to delete.
+            dimension (int): The dimension of the vectors in the index.
+        """
+        self.delete_vectors(username, [id], dimension)
+
+    def delete_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Deletes several vectors from the user's local index, rewriting the index file once.
+
+        Args:
+            username (str): The username whose index is being updated.
+            ids (list): The unique identifiers of the vectors to delete.
+            dimension (int): The dimension of the vectors in the index.
+        """
+        self._load(username, dimension)
+        with self._lock:
+            index = self._indexes[username]
+            ids = set(ids)
+            positions = [index.positions[id] for id in ids if id in index.positions]
+            if not positions:
+                return
+            removed = set(positions)
+            kept_ids = [id for position, id in enumerate(index.ids) if position not in removed]
+            matrix = np.delete(np.asarray(index.matrix), positions, axis=0)
+            metadata = {id: value for id, value in index.metadata.items() if id not in ids}
+            index = _LocalIndex(kept_ids, np.ascontiguousarray(matrix, dtype=np.float32), metadata)
+            self._save(username, index)
+            self._indexes[username] = index
+
+    def fetch_vector(self, username: str, id: str, dimension: int):
+        """
+        Fetches a vector from the user's local index by its ID.
+
+        Args:
+            username (str): The username whose index is being queried.
+            id (str): The unique identifier of the vector to fetch.
+            dimension (int): The dimension of the vectors in the index.
+
+        Returns:
+            dict: The fetched vector, shaped like Pinecone's fetch response. Values are unit-normalized.
+        """
+        return self.fetch_vectors(username, [id], dimension)
+
+    def fetch_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Fetches several vectors from the user's local index by their IDs.
+
+        Args:
+            username (str): The username whose index is being queried.
+            ids (list): The unique identifiers of the vectors to fetch.
+            dimension (int): The dimension of the vectors in the index.
+
+        Returns:
+            dict: The fetched vectors keyed by ID under "vectors". Values are unit-normalized.
+        """
+        index = self._load(username, dimension)
+        vectors = {id: {"id": id, "values": index.matrix[index.positions[id]].tolist()}
+                   for id in ids if id in index.positions}
+        return {"vectors": vectors, "namespace": ""}
+
+    def describe_user_index(self, username: str, dimension: int):
+        """
+        Describes the statistics of the user's local index.
+
+        Args:
+            username (str): The username whose index is being described.
+            dimension (int): The dimension of the vectors in the index.
+
+        Returns:
+            dict: The index statistics.
+        """
+        index = self._load(username, dimension)
+        return {"dimension": dimension, "total_vector_count": len(index.ids),
+                "namespaces": {"": {"vector_count": len(index.ids)}}}
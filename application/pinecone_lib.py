@@ -1,6 +1,9 @@
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 
-import pinecone
+from application.vector_store import VectorStore
+from core.config import pinecone_settings, require_setting
 
 
 def get_user_index_name(username: str) -> str:
@@ -16,16 +19,73 @@ def get_user_index_name(username: str) -> str:
     return f"user-{username}-index"
 
 
-class PineconeHelper:
+def locate_user_vectors(username: str) -> Tuple[str, str]:
+    """
+    Finds where a user's vectors live. Names listed in PINECONE_DEDICATED_INDEXES keep an index of their own;
+    every other user is a namespace of the shared index, so new users cost no index creation.
+
+    Args:
+        username (str): The username, or the name of a dedicated index such as "files".
+
+    Returns:
+        tuple: The index name and the namespace ("" for dedicated indexes).
+    """
+    if username in pinecone_settings.DEDICATED_INDEXES:
+        return get_user_index_name(username), ""
+    return pinecone_settings.SHARED_INDEX, username
+
+
+class PineconeHelper(VectorStore):
     def __init__(self):
         """
-        Initializes the Pinecone client using the provided API key.
+        Initializes the helper. The Pinecone client is created on first use.
         """
-        self.pc = pinecone.Pinecone(api_key=os.getenv("CONNECTION_STRINGS_PINECONE"))
+        self._pc = None
+        self._client_lock = threading.Lock()
+        # Index handles by name, and the names known to exist, so data-plane calls skip list_indexes
+        self._indexes = {}
+        self._existing_indexes = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pinecone_settings.BATCH_CONCURRENCY,
+                                            thread_name_prefix="pinecone-batch")
+
+    @property
+    def pc(self):
+        if self._pc is None:
+            with self._client_lock:
+                if self._pc is None:
+                    import pinecone
+
+                    self._pc = pinecone.Pinecone(
+                        api_key=require_setting(pinecone_settings.API_KEY, "CONNECTION_STRINGS_PINECONE"))
+        return self._pc
+
+    def preload(self, username: str):
+        """
+        Opens the handle of the user's index and its connection, so the first query does not pay for them.
+
+        Args:
+            username (str): The username whose index is opened.
+        """
+        self._index(locate_user_vectors(username)[0]).describe_index_stats()
+
+    def _index(self, index_name: str):
+        index = self._indexes.get(index_name)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(index_name)
+                if index is None:
+                    index = self.pc.Index(index_name)
+                    self._indexes[index_name] = index
+        return index
 
     def create_user_index(self, username: str, dimension: int):
         """
-        Creates a Pinecone index for a specific user if it does not already exist.
+        Creates the Pinecone index holding a user's vectors if it does not already exist.
+
+        For most users that is the shared index, created once. The list of existing indexes is fetched once and
+        then kept up to date locally, and index handles are reused, so only the first call for an index talks to
+        the control plane.
 
         Args:
             username (str): The username for which to create the index.
@@ -34,15 +94,29 @@ class PineconeHelper:
         Returns:
             Index: The created or existing Pinecone index.
         """
-        index_name = get_user_index_name(username)
-        if index_name not in self.pc.list_indexes().names():
-            self.pc.create_index(
-                name=index_name,
-                dimension=dimension,
-                metric='cosine',
-                spec=pinecone.ServerlessSpec(cloud='aws', region='us-east-1')
-            )
-        return self.pc.Index(index_name)
+        index_name, _ = locate_user_vectors(username)
+        if index_name in self._indexes:
+            return self._indexes[index_name]
+        from pinecone import ServerlessSpec
+
+        with self._lock:
+            if self._existing_indexes is None:
+                self._existing_indexes = set(self.pc.list_indexes().names())
+            if index_name not in self._existing_indexes:
+                self.pc.create_index(
+                    name=index_name,
+                    dimension=dimension,
+                    metric='cosine',
+                    spec=ServerlessSpec(cloud='aws', region='us-east-1')
+                )
+                self._existing_indexes.add(index_name)
+        return self._index(index_name)
+
+    def _run_batches(self, operation, items: list, batch_size: int) -> list:
+        batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+        if len(batches) <= 1:
+            return [operation(batch) for batch in batches]
+        return list(self._executor.map(operation, batches))
 
     def insert_vector(self, username: str, id: str, vector: list, dimension: int):
         """
@@ -59,11 +133,30 @@ class PineconeHelper:
         """
         if len(vector) != dimension:
             raise ValueError(f"Vector dimension should be {dimension}")
+        self.insert_vectors(username, [(id, vector)], dimension)
+
+    def insert_vectors(self, username: str, vectors: list, dimension: int):
+        """
+        Inserts or updates many vectors in the user's Pinecone index using concurrent batched upserts.
+
+        Args:
+            username (str): The username whose index is being updated.
+            vectors (list): (id, values) pairs, or (id, values, metadata) triples.
+            dimension (int): The dimension of the vectors.
+
+        Raises:
+            ValueError: If the dimension of any vector does not match the specified dimension.
+        """
+        if any(len(vector[1]) != dimension for vector in vectors):
+            raise ValueError(f"Vector dimension should be {dimension}")
         index = self.create_user_index(username, dimension)
-        upsert_data = [{"id": id, "values": vector}]
-        index.upsert(vectors=upsert_data)
+        _, namespace = locate_user_vectors(username)
+        upsert_data = [{"id": vector[0], "values": vector[1], **({"metadata": vector[2]} if len(vector) > 2 else {})}
+                       for vector in vectors]
+        self._run_batches(lambda batch: index.upsert(vectors=batch, namespace=namespace), upsert_data,
+                          pinecone_settings.UPSERT_BATCH_SIZE)
 
-    def query_vector(self, username: str, vector: list, top_k: int, dimension: int):
+    def query_vector(self, username: str, vector: list, top_k: int, dimension: int, include_values: bool = False):
         """
         Queries the user's Pinecone index for the most similar vectors.
 
@@ -72,17 +165,37 @@ class PineconeHelper:
             vector (list): The query vector.
             top_k (int): The number of top similar vectors to return.
             dimension (int): The dimension of the query vector.
+            include_values (bool): Whether to return the stored vectors along with the matches.
 
         Returns:
-            dict: The query results.
+            dict: The query results, with the metadata stored alongside each match.
 
         Raises:
             ValueError: If the dimension of the vector does not match the specified dimension.
         """
         if len(vector) != dimension:
             raise ValueError(f"Vector dimension should be {dimension}")
-        index = self.pc.Index(get_user_index_name(username))
-        return index.query(vector=vector, top_k=top_k, include_values=True)
+        index_name, namespace = locate_user_vectors(username)
+        return self._index(index_name).query(vector=vector, top_k=top_k, namespace=namespace,
+                                             include_values=include_values, include_metadata=True)
+
+    def query_vectors(self, username: str, vectors: list, top_k: int, dimension: int):
+        """
+        Queries the user's Pinecone index with several vectors, running up to PINECONE_BATCH_CONCURRENCY queries
+        at once.
+
+        Args:
+            username (str): The username whose index is being queried.
+            vectors (list): The query vectors.
+            top_k (int): The number of top similar vectors to return per query.
+            dimension (int): The dimension of the query vectors.
+
+        Returns:
+            list: One query result per vector, in input order.
+        """
+        if len(vectors) <= 1:
+            return [self.query_vector(username, vector, top_k, dimension) for vector in vectors]
+        return list(self._executor.map(lambda vector: self.query_vector(username, vector, top_k, dimension), vectors))
 
     def delete_vector(self, username: str, id: str, dimension: int):
         """
@@ -93,8 +206,21 @@ class PineconeHelper:
             id (str): The unique identifier of the vector to delete.
             dimension (int): The dimension of the vectors in the index.
         """
+        self.delete_vectors(username, [id], dimension)
+
+    def delete_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Deletes many vectors from the user's Pinecone index using concurrent batched requests.
+
+        Args:
+            username (str): The username whose index is being updated.
+            ids (list): The unique identifiers of the vectors to delete.
+            dimension (int): The dimension of the vectors in the index.
+        """
         index = self.create_user_index(username, dimension)
-        index.delete(ids=[id])
+        _, namespace = locate_user_vectors(username)
+        self._run_batches(lambda batch: index.delete(ids=batch, namespace=namespace), list(ids),
+                          pinecone_settings.DELETE_BATCH_SIZE)
 
     def fetch_vector(self, username: str, id: str, dimension: int):
         """
@@ -108,8 +234,27 @@ class PineconeHelper:
         Returns:
             dict: The fetched vector.
         """
+        return self.fetch_vectors(username, [id], dimension)
+
+    def fetch_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Fetches many vectors from the user's Pinecone index using concurrent batched requests.
+
+        Args:
+            username (str): The username whose index is being queried.
+            ids (list): The unique identifiers of the vectors to fetch.
+            dimension (int): The dimension of the vectors in the index.
+
+        Returns:
+            dict: The fetched vectors keyed by ID under "vectors".
+        """
         index = self.create_user_index(username, dimension)
-        return index.fetch(ids=[id])
+        _, namespace = locate_user_vectors(username)
+        vectors = {}
+        for response in self._run_batches(lambda batch: index.fetch(ids=batch, namespace=namespace), list(ids),
+                                          pinecone_settings.FETCH_BATCH_SIZE):
+            vectors.update(response['vectors'])
+        return {"vectors": vectors}
 
     def describe_user_index(self, username: str, dimension: int):
         """
@@ -120,10 +265,16 @@ class PineconeHelper:
             dimension (int): The dimension of the vectors in the index.
 
         Returns:
-            dict: The index statistics.
+            dict: The index statistics. For users in the shared index, only their namespace is described.
         """
         index = self.create_user_index(username, dimension)
-        return index.describe_index_stats()
+        _, namespace = locate_user_vectors(username)
+        stats = index.describe_index_stats()
+        if not namespace:
+            return stats
+        namespace_stats = stats["namespaces"].get(namespace)
+        return {"dimension": stats["dimension"], "namespace": namespace,
+                "vector_count": namespace_stats["vector_count"] if namespace_stats else 0}
 
     def update_index_data(self, username: str, id: str, new_namespace: str, vector: list):
         """
@@ -138,9 +289,10 @@ class PineconeHelper:
         Raises:
             ValueError: If the dimension of the vector does not match the specified dimension.
         """
-        index_name = get_user_index_name(username)
-        index = self.pc.Index(index_name)
-        index.upsert(vectors=[{"id": id, "values": vector}], namespace=new_namespace)
+        index_name, namespace = locate_user_vectors(username)
+        # Users of the shared index already are a namespace, so theirs are nested under it
+        self._index(index_name).upsert(vectors=[{"id": id, "values": vector}],
+                                       namespace=f"{namespace}/{new_namespace}" if namespace else new_namespace)
 
     def get_message_by_id(self, username: str, id: str, dimension: int):
         """
@@ -154,8 +306,7 @@ class PineconeHelper:
         Returns:
             str: The message stored in the metadata, or None if not found.
         """
-        index = self.create_user_index(username, dimension)
-        response = index.fetch(ids=[id])
+        response = self.fetch_vectors(username, [id], dimension)
         if id in response['vectors']:
             return response['vectors'][id].get('metadata', {}).get('original_data', None)
         return None
@@ -0,0 +1,143 @@
+from functools import lru_cache
+from typing import List, Tuple
+
+import tiktoken
+
+from core.config import prompt_settings
+
+# Generous bound on the characters per token, so a prefix this many times the token limit long overflows it
+CHARS_PER_TOKEN_BOUND = 8
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = prompt_settings.TOKENIZER_ENCODING):
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text with the model tokenizer.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return len(get_encoding().encode(text, disallowed_special=()))
+
+
+def _encode_prefix(text: str, max_tokens: int) -> Tuple[list, bool]:
+    """
+    Tokenizes only as much of a text as it takes to tell whether it fits in max_tokens, so the cost does not grow
+    with the length of the text.
+
+    Returns:
+        tuple: The tokens of the prefix, and whether the prefix is the whole text.
+    """
+    length = (max_tokens + 1) * CHARS_PER_TOKEN_BOUND
+    while True:
+        prefix = text[:length]
+        tokens = get_encoding().encode(prefix, disallowed_special=())
+        if len(prefix) == len(text) or len(tokens) > max_tokens:
+            return tokens, len(prefix) == len(text)
+        length *= 2
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cuts a text down to at most max_tokens tokens.
+
+    Args:
+        text (str): The text to truncate.
+        max_tokens (int): The token limit.
+
+    Returns:
+        str: The text itself if it fits, otherwise its longest prefix that does.
+    """
+    if max_tokens <= 0:
+        return ""
+    tokens, complete = _encode_prefix(text, max_tokens)
+    if complete and len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens])
+
+
+def truncate_history(conversation_history: List[str], max_tokens: int = prompt_settings.HISTORY_MAX_TOKENS):
+    """
+    Keeps the most recent history lines that fit in the token limit.
+
+    Args:
+        conversation_history (list): History lines, oldest first.
+        max_tokens (int): The token limit for the whole history.
+
+    Returns:
+        list: The newest lines that fit, oldest first.
+    """
+    total_tokens = 0
+    truncated_history = []
+    for message in reversed(conversation_history):
+        total_tokens += count_tokens(message) + 1
+        if total_tokens > max_tokens:
+            break
+        truncated_history.append(message)
+    truncated_history.reverse()
+    return truncated_history
+
+
+def fit_passages(passages: List[str], max_tokens: int) -> str:
+    """
+    Packs ranked passages into the context budget, truncating the last one that only partly fits.
+
+    Passages are only tokenized up to the remaining budget, so a whole document costs no more than a short passage.
+
+    Args:
+        passages (list): Passages, best first.
+        max_tokens (int): The token limit for the context.
+
+    Returns:
+        str: The selected passages separated by blank lines.
+    """
+    selected = []
+    remaining = max_tokens
+    for passage in passages:
+        # Two tokens are kept for the separator
+        budget = remaining - 2
+        if budget <= 0:
+            break
+        tokens, complete = _encode_prefix(passage, budget)
+        if not complete or len(tokens) > budget:
+            truncated = get_encoding().decode(tokens[:budget])
+            if truncated:
+                selected.append(truncated)
+            break
+        selected.append(passage)
+        remaining -= len(tokens) + 2
+    return "\n\n".join(selected)
+
+
+def build_prompt(template: str, user_prompt: str, passages: List[str], history: List[str], summary: str = "") -> str:
+    """
+    Fills the prompt template while keeping the whole prompt within the configured token budget.
+
+    The question, the summary and the history are capped first; the context gets whatever is left of the budget.
+
+    Args:
+        template (str): Template with {context}, {conversation_history} and {user_prompt} fields.
+        user_prompt (str): The customer's question.
+        passages (list): Retrieved passages, best first.
+        history (list): Conversation history lines, oldest first.
+        summary (str): Summary of the conversation before the history lines, if any.
+
+    Returns:
+        str: The formatted prompt.
+    """
+    overhead = count_tokens(template.format(context="", conversation_history="", user_prompt=""))
+    question = truncate_to_tokens(user_prompt, prompt_settings.QUESTION_MAX_TOKENS)
+    history_lines = truncate_history(history, prompt_settings.HISTORY_MAX_TOKENS)
+    if summary:
+        history_lines.insert(0, f"summary: {truncate_to_tokens(summary, prompt_settings.SUMMARY_MAX_TOKENS)}")
+    history_text = "\n".join(history_lines)
+    context_budget = prompt_settings.MAX_TOKENS - overhead - count_tokens(question) - count_tokens(history_text)
+    context = fit_passages(passages, context_budget)
+    return template.format(context=context, conversation_history=history_text, user_prompt=question)
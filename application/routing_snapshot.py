@@ -0,0 +1,160 @@
+import json
+import mmap
+import os
+import re
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from application.local_vector_store import LocalVectorStore, _normalize
+
+CURRENT_FILE = "CURRENT"
+TEXTS_FILE = "texts.bin"
+MANIFEST_FILE = "manifest.json"
+VERSION_PATTERN = re.compile(r"^v(\d+)$")
+
+
+def current_version(root: str) -> Optional[str]:
+    """
+    Reads the name of the published snapshot version.
+
+    Args:
+        root (str): Directory holding the snapshot versions.
+
+    Returns:
+        str: The version directory name, or None if nothing was published yet.
+    """
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _versions(root: str) -> List[Tuple[int, str]]:
+    versions = []
+    for name in os.listdir(root):
+        match = VERSION_PATTERN.match(name)
+        if match:
+            versions.append((int(match.group(1)), name))
+    return sorted(versions)
+
+
+def write_snapshot(root: str, index_name: str, vectors: List[Tuple[str, list]], documents: Iterable[dict],
+                   chunks: Iterable[dict], keep: int = 3) -> str:
+    """
+    Writes a new snapshot version and publishes it by atomically replacing the CURRENT pointer.
+
+    The version is written to a temporary directory first, so readers never see a partial snapshot. Older
+    versions beyond `keep` are removed; workers still mapping them keep their pages until they reload.
+
+    Args:
+        root (str): Directory holding the snapshot versions.
+        index_name (str): Name of the vector index stored in the snapshot.
+        vectors (list): (id, values) pairs of the routing vectors.
+        documents (iterable): Documents with title, content, source and vector_ids.
+        chunks (iterable): Chunks with _id, title and content.
+        keep (int): Number of versions kept on disk, including the new one.
+
+    Returns:
+        str: The name of the published version.
+    """
+    os.makedirs(root, exist_ok=True)
+    versions = _versions(root)
+    name = f"v{versions[-1][0] + 1 if versions else 1}"
+    staging = os.path.join(root, f".{name}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    if vectors:
+        matrix = _normalize(np.asarray([values for _, values in vectors], dtype=np.float32))
+    else:
+        matrix = np.empty((0, 0), dtype=np.float32)
+    dimension = matrix.shape[1]
+    np.save(os.path.join(staging, f"{index_name}.npy"), np.ascontiguousarray(matrix))
+    with open(os.path.join(staging, f"{index_name}.json"), "w") as f:
+        json.dump({"ids": [id for id, _ in vectors], "dimension": dimension}, f)
+
+    manifest = {"index": index_name, "documents": [], "chunks": {}}
+    offset = 0
+    with open(os.path.join(staging, TEXTS_FILE), "wb") as f:
+        def append(text: str) -> List[int]:
+            nonlocal offset
+            data = text.encode("utf-8")
+            f.write(data)
+            offset += len(data)
+            return [offset - len(data), len(data)]
+
+        for document in documents:
+            manifest["documents"].append({"title": document["title"], "source": document.get("source"),
+                                          "vector_ids": document.get("vector_ids") or [],
+                                          "text": append(document["content"])})
+        for chunk in chunks:
+            manifest["chunks"][chunk["_id"]] = [chunk["title"], *append(chunk["content"])]
+    with open(os.path.join(staging, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+
+    os.rename(staging, os.path.join(root, name))
+    with open(os.path.join(root, f"{CURRENT_FILE}.tmp"), "w") as f:
+        f.write(name)
+    os.replace(os.path.join(root, f"{CURRENT_FILE}.tmp"), os.path.join(root, CURRENT_FILE))
+
+    for _, old in _versions(root)[:-keep]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return name
+
+
+class RoutingSnapshot:
+    def __init__(self, root: str, version: str):
+        """
+        Opens a published snapshot read-only.
+
+        The vector matrix and the text blob are memory-mapped, so every worker process on the host shares one
+        copy through the page cache; only the manifest is parsed per process.
+
+        Args:
+            root (str): Directory holding the snapshot versions.
+            version (str): The version directory name.
+        """
+        self.version = version
+        self.path = os.path.join(root, version)
+        with open(os.path.join(self.path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.index_name = manifest["index"]
+        self.documents: Dict[str, dict] = {document["title"]: document for document in manifest["documents"]}
+        self._chunks: Dict[str, list] = manifest["chunks"]
+        self.vector_store = LocalVectorStore(self.path)
+        self.vector_store.preload(self.index_name)
+        self._texts = None
+        with open(os.path.join(self.path, TEXTS_FILE), "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self._texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open_current(cls, root: str) -> Optional["RoutingSnapshot"]:
+        """
+        Opens the published snapshot version, or returns None if nothing was published yet.
+        """
+        version = current_version(root)
+        return cls(root, version) if version else None
+
+    def _text(self, offset: int, length: int) -> str:
+        return self._texts[offset:offset + length].decode("utf-8") if length else ""
+
+    def document_text(self, title: str) -> Optional[str]:
+        document = self.documents.get(title)
+        return self._text(*document["text"]) if document else None
+
+    def chunk(self, id: str) -> Optional[dict]:
+        entry = self._chunks.get(id)
+        if entry is None:
+            return None
+        title, offset, length = entry
+        return {"_id": id, "title": title, "content": self._text(offset, length)}
+
+    def chunk_units(self) -> List[Tuple[str, str, str]]:
+        """
+        Returns (id, title, content) of every chunk.
+        """
+        return [(id, title, self._text(offset, length)) for id, (title, offset, length) in self._chunks.items()]
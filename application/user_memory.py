@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from application.vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Recall vectors are stored under a prefixed name, so no username can reach the routing index or another store
+RECALL_PREFIX = "u:"
+
+
+def recall_index_name(username: str) -> str:
+    """
+    Returns the name a user's recall vectors are stored under in the vector store.
+    """
+    return f"{RECALL_PREFIX}{username}"
+
+
+class UserMessageIndexer:
+    def __init__(self, embed: Callable[[List[str]], Awaitable[List[list]]], store: VectorStore, dimension: int,
+                 max_batch: int, flush_interval: float, max_pending: int):
+        """
+        Embeds users' messages in the background and stores them in each user's vector index for recall.
+
+        Messages are queued without waiting and embedded in batches, one embedding request per batch. Prompts that
+        were just routed are usually served from the embedding cache, so indexing them costs no request at all.
+
+        Args:
+            embed: Coroutine function returning one embedding per text, in input order.
+            store (VectorStore): The vector store holding the users' messages.
+            dimension (int): The dimension of the embeddings.
+            max_batch (int): Number of queued messages that triggers an immediate flush, and the most embedded
+                at once.
+            flush_interval (float): Seconds between background flushes.
+            max_pending (int): Queue size beyond which new messages are not indexed.
+        """
+        self.embed = embed
+        self.store = store
+        self.dimension = dimension
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: List[Tuple[str, str, str]] = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def enqueue(self, username: str, message_id: str, text: str):
+        """
+        Queues a message for indexing. Recall is best effort, so a full queue drops the message rather than
+        slowing down the request.
+        """
+        if len(self._pending) >= self.max_pending:
+            logger.warning("Dropping a message of %s from the recall index, %d are queued", username,
+                           len(self._pending))
+            return
+        self._pending.append((username, message_id, text))
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                try:
+                    await self._index(batch)
+                except Exception:
+                    logger.exception("Failed to index %d messages for recall", len(batch))
+
+    async def _index(self, batch: List[Tuple[str, str, str]]):
+        vectors = await self.embed([text for _, _, text in batch])
+        by_user: Dict[str, list] = {}
+        for (username, message_id, text), vector in zip(batch, vectors):
+            by_user.setdefault(recall_index_name(username), []).append((message_id, vector, {"original_data": text}))
+        # One upsert per user, since each user is a namespace of their own
+        await asyncio.gather(*(asyncio.to_thread(self.store.insert_vectors, username, user_vectors, self.dimension)
+                               for username, user_vectors in by_user.items()))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,128 @@
+import asyncio
+from abc import ABC, abstractmethod
+from functools import partial
+
+from core.config import vector_store_settings
+
+
+class QueryResult(dict):
+    """
+    Query response shaped like Pinecone's, so callers can use either `result.matches` or `result['matches']`.
+    """
+
+    @property
+    def matches(self):
+        return self["matches"]
+
+
+class VectorStore(ABC):
+    @abstractmethod
+    def insert_vector(self, username: str, id: str, vector: list, dimension: int):
+        """
+        Inserts or updates a vector in the user's index.
+        """
+
+    @abstractmethod
+    def query_vector(self, username: str, vector: list, top_k: int, dimension: int):
+        """
+        Queries the user's index for the most similar vectors.
+        """
+
+    async def aquery_vector(self, username: str, vector: list, top_k: int, dimension: int):
+        """
+        Queries the user's index without blocking the event loop by running the query in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.query_vector, username, vector, top_k, dimension))
+
+    def query_vectors(self, username: str, vectors: list, top_k: int, dimension: int):
+        """
+        Queries the user's index with several vectors, returning one result per vector in input order.
+        """
+        return [self.query_vector(username, vector, top_k, dimension) for vector in vectors]
+
+    async def aquery_vectors(self, username: str, vectors: list, top_k: int, dimension: int):
+        """
+        Queries the user's index with several vectors without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, partial(self.query_vectors, username, vectors, top_k, dimension))
+
+    @abstractmethod
+    def delete_vector(self, username: str, id: str, dimension: int):
+        """
+        Deletes a vector from the user's index.
+        """
+
+    @abstractmethod
+    def fetch_vector(self, username: str, id: str, dimension: int):
+        """
+        Fetches a vector from the user's index by its ID.
+        """
+
+    @abstractmethod
+    def describe_user_index(self, username: str, dimension: int):
+        """
+        Describes the statistics of the user's index.
+        """
+
+    def insert_vectors(self, username: str, vectors: list, dimension: int):
+        """
+        Inserts or updates several (id, values) pairs, or (id, values, metadata) triples, in the user's index.
+        """
+        for id, vector, *_ in vectors:
+            self.insert_vector(username, id, vector, dimension)
+
+    def delete_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Deletes several vectors from the user's index.
+        """
+        for id in ids:
+            self.delete_vector(username, id, dimension)
+
+    def fetch_vectors(self, username: str, ids: list, dimension: int):
+        """
+        Fetches several vectors from the user's index by their IDs.
+        """
+        vectors = {}
+        for id in ids:
+            vectors.update(self.fetch_vector(username, id, dimension)['vectors'])
+        return {"vectors": vectors}
+
+    def preload(self, username: str):
+        """
+        Makes the user's index ready to serve queries. Backends without local state do nothing.
+        """
+
+
+def create_vector_store() -> VectorStore:
+    """
+    Builds the vector store selected by the VECTOR_STORE_BACKEND setting.
+
+    Returns:
+        VectorStore: A PineconeHelper for "pinecone", a LocalVectorStore for "local".
+    """
+    backend = vector_store_settings.BACKEND
+    if backend == "pinecone":
+        from application.pinecone_lib import PineconeHelper
+        return PineconeHelper()
+    if backend == "local":
+        from application.local_vector_store import LocalVectorStore
+        return LocalVectorStore(vector_store_settings.LOCAL_PATH)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def copy_vectors(source: VectorStore, target: VectorStore, username: str, ids: list, dimension: int):
+    """
+    Copies vectors between stores, e.g. to seed a local index from Pinecone.
+
+    Args:
+        source (VectorStore): The store to read the vectors from.
+        target (VectorStore): The store to write the vectors to.
+        username (str): The username whose index is being copied.
+        ids (list): The identifiers of the vectors to copy.
+        dimension (int): The dimension of the vectors.
+    """
+    response = source.fetch_vectors(username, ids, dimension)
+    target.insert_vectors(username, [(id, list(vector['values'])) for id, vector in response['vectors'].items()],
+                          dimension)
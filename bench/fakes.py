@@ -0,0 +1,366 @@
+import asyncio
+import copy
+import hashlib
+import time
+from typing import AsyncIterator, List
+
+import numpy as np
+from bson import ObjectId
+from langchain_core.messages import AIMessage, AIMessageChunk
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class FakeEmbeddings:
+    def __init__(self, dimension: int, latency: float):
+        """
+        Stand-in for AzureOpenAIEmbeddings that returns deterministic vectors after a fixed delay.
+
+        Args:
+            dimension (int): The dimension of the returned vectors.
+            latency (float): Seconds each API call takes.
+        """
+        self.dimension = dimension
+        self.latency = latency
+        self.calls = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.lower().encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return self._vector(text)
+
+    def embed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+
+class FakeChatModel:
+    def __init__(self, latency: float, first_token_latency: float, reply: str = "Thanks for reaching out! "
+                                                                              "Here is how to do that."):
+        """
+        Stand-in for AzureChatOpenAI with a configurable time to first token and total latency.
+
+        Args:
+            latency (float): Seconds a complete reply takes.
+            first_token_latency (float): Seconds until the first streamed token.
+            reply (str): The reply returned for every prompt.
+        """
+        self.latency = latency
+        self.first_token_latency = first_token_latency
+        self.reply = reply
+        self.calls = 0
+
+    def _usage(self, messages) -> dict:
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        output_tokens = len(self.reply.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    async def ainvoke(self, messages, **kwargs) -> AIMessage:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self.reply, usage_metadata=self._usage(messages))
+
+    async def astream(self, messages, **kwargs) -> AsyncIterator[AIMessageChunk]:
+        self.calls += 1
+        await asyncio.sleep(self.first_token_latency)
+        words = self.reply.split(" ")
+        delay = max(self.latency - self.first_token_latency, 0) / max(len(words), 1)
+        for position, word in enumerate(words):
+            yield AIMessageChunk(content=word if position == 0 else f" {word}")
+            await asyncio.sleep(delay)
+
+
+class ApproximateEncoding:
+    """
+    Whitespace tokenizer used when the tiktoken encoding files cannot be downloaded.
+    """
+
+    def encode(self, text: str, disallowed_special=()) -> List[str]:
+        return text.split(" ")
+
+    def decode(self, tokens: List[str]) -> str:
+        return " ".join(tokens)
+
+
+def _get_path(document: dict, path: str):
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else None
+        elif isinstance(value, list):
+            # Like Mongo, a path through an array collects the field of every element
+            value = [item.get(part) for item in value if isinstance(item, dict)]
+        else:
+            return None
+    return value
+
+
+def _matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$lt" and not (value is not None and value < operand):
+                return False
+            if operator == "$lte" and not (value is not None and value <= operand):
+                return False
+            if operator == "$gt" and not (value is not None and value > operand):
+                return False
+            if operator == "$gte" and not (value is not None and value >= operand):
+                return False
+            values = value if isinstance(value, list) else [value]
+            if operator == "$in" and not any(item in operand for item in values):
+                return False
+            if operator == "$nin" and any(item in operand for item in values):
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$exists" and (value is not None) != operand:
+                return False
+        return True
+    return value == condition
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, branch) for branch in condition):
+                return False
+        elif not _matches_condition(_get_path(document, key), condition):
+            return False
+    return True
+
+
+def _project(document: dict, projection) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    # Dotted paths keep their whole top-level field, which is a superset of what Mongo returns
+    included = {key.split(".")[0] for key, value in projection.items() if value}
+    result = {key: copy.deepcopy(value) for key, value in document.items() if key in included}
+    if projection.get("_id", 1) and "_id" in document:
+        result["_id"] = document["_id"]
+    return result
+
+
+def _apply_update(document: dict, update: dict, inserting: bool):
+    for key, value in update.get("$set", {}).items():
+        document[key] = copy.deepcopy(value)
+    if inserting:
+        for key, value in update.get("$setOnInsert", {}).items():
+            document[key] = copy.deepcopy(value)
+    for key, value in update.get("$min", {}).items():
+        document[key] = value if document.get(key) is None else min(document[key], value)
+    for key, value in update.get("$max", {}).items():
+        document[key] = value if document.get(key) is None else max(document[key], value)
+    for key, value in update.get("$inc", {}).items():
+        document[key] = document.get(key, 0) + value
+    for key, value in update.get("$push", {}).items():
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        document.setdefault(key, []).extend(copy.deepcopy(items))
+    if not any(key.startswith("$") for key in update):
+        replacement = copy.deepcopy(update)
+        replacement["_id"] = document["_id"]
+        document.clear()
+        document.update(replacement)
+
+
+class _Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class InMemoryCursor:
+    def __init__(self, documents: List[dict], projection=None):
+        self._documents = documents
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=None):
+        keys = key_or_list if isinstance(key_or_list, list) else [(key_or_list, direction or 1)]
+        for key, key_direction in reversed(keys):
+            self._documents.sort(key=lambda document: (_get_path(document, key) is not None,
+                                                       _get_path(document, key)), reverse=key_direction < 0)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def _selected(self) -> List[dict]:
+        selected = self._documents[self._skip:]
+        if self._limit:
+            selected = selected[:self._limit]
+        return [_project(document, self._projection) for document in selected]
+
+    async def to_list(self, length=None):
+        selected = self._selected()
+        return selected[:length] if length else selected
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._selected():
+            yield document
+
+
+def _index_values(document: dict, path: str) -> list:
+    value = _get_path(document, path)
+    values = value if isinstance(value, list) else [value]
+    # Documents without the field are not indexed, as if every unique index were sparse
+    return [value for value in values if value is not None]
+
+
+class InMemoryCollection:
+    def __init__(self, name: str):
+        """
+        The subset of the Motor collection API used by the repositories, backed by a list of dicts.
+
+        Unique indexes on a single field, and the implicit one on _id, reject duplicates with error code 11000
+        like Mongo does. Other indexes are accepted and ignored.
+        """
+        self.name = name
+        self.documents: List[dict] = []
+        self.unique_fields: List[str] = ["_id"]
+
+    async def create_index(self, keys, **kwargs):
+        fields = [keys] if isinstance(keys, str) else [key for key, _ in keys]
+        if kwargs.get("unique") and len(fields) == 1 and fields[0] not in self.unique_fields:
+            self.unique_fields.append(fields[0])
+        return keys if isinstance(keys, str) else "_".join(f"{key}_{direction}" for key, direction in keys)
+
+    def _check_unique(self, candidate: dict, replacing: dict = None):
+        """
+        Raises DuplicateKeyError if the candidate repeats a unique field of a stored document other than the one
+        it replaces.
+        """
+        for field in self.unique_fields:
+            values = _index_values(candidate, field)
+            if not values:
+                continue
+            for document in self.documents:
+                if document is replacing:
+                    continue
+                stored = _index_values(document, field)
+                duplicate = next((value for value in values if value in stored), None)
+                if duplicate is not None:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {field} "
+                                            f"dup key: {{ {field}: {duplicate!r} }}", DUPLICATE_KEY_ERROR)
+
+    async def find_one(self, query: dict, projection=None):
+        for document in self.documents:
+            if matches(document, query):
+                return _project(document, projection)
+        return None
+
+    def find(self, query: dict = None, projection=None) -> InMemoryCursor:
+        return InMemoryCursor([document for document in self.documents if matches(document, query or {})],
+                              projection)
+
+    async def insert_one(self, document: dict):
+        document.setdefault("_id", ObjectId())
+        self._check_unique(document)
+        self.documents.append(copy.deepcopy(document))
+        return _Result(inserted_id=document["_id"])
+
+    async def insert_many(self, documents: List[dict], ordered: bool = True):
+        errors = []
+        for position, document in enumerate(documents):
+            try:
+                await self.insert_one(document)
+            except DuplicateKeyError as exc:
+                errors.append({"index": position, "code": exc.code, "errmsg": str(exc)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(documents) - len(errors)})
+        return _Result(inserted_ids=[document["_id"] for document in documents])
+
+    def _update(self, document: dict, update: dict):
+        updated = copy.deepcopy(document)
+        _apply_update(updated, update, inserting=False)
+        self._check_unique(updated, replacing=document)
+        document.clear()
+        document.update(updated)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        for document in self.documents:
+            if matches(document, query):
+                self._update(document, update)
+                return _Result(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            document = {key: value for key, value in query.items()
+                        if not key.startswith("$") and not isinstance(value, dict)}
+            document.setdefault("_id", ObjectId())
+            _apply_update(document, update, inserting=True)
+            self._check_unique(document)
+            self.documents.append(document)
+            return _Result(matched_count=0, modified_count=0, upserted_id=document["_id"])
+        return _Result(matched_count=0, modified_count=0, upserted_id=None)
+
+    async def update_many(self, query: dict, update: dict):
+        matched = [document for document in self.documents if matches(document, query)]
+        for document in matched:
+            self._update(document, update)
+        return _Result(matched_count=len(matched), modified_count=len(matched))
+
+    async def delete_one(self, query: dict):
+        for position, document in enumerate(self.documents):
+            if matches(document, query):
+                del self.documents[position]
+                return _Result(deleted_count=1)
+        return _Result(deleted_count=0)
+
+    async def delete_many(self, query: dict):
+        kept = [document for document in self.documents if not matches(document, query)]
+        deleted = len(self.documents) - len(kept)
+        self.documents = kept
+        return _Result(deleted_count=deleted)
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        upserted = modified = 0
+        errors = []
+        for position, request in enumerate(requests):
+            try:
+                result = await self.update_one(request._filter, request._doc, upsert=request._upsert)
+            except DuplicateKeyError as exc:
+                errors.append({"index": position, "code": exc.code, "errmsg": str(exc)})
+                if ordered:
+                    break
+                continue
+            upserted += result.upserted_id is not None
+            modified += result.modified_count
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nUpserted": upserted, "nModified": modified})
+        return _Result(upserted_count=upserted, modified_count=modified)
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure("The in-memory database does not support change streams")
+
+    async def count_documents(self, query: dict):
+        return sum(1 for document in self.documents if matches(document, query))
@@ -0,0 +1,60 @@
+"""
+Measures how long a fresh interpreter takes to import the API, and which heavy client libraries it loads.
+
+    python -m bench.import_time --budget 2.5
+
+Prints the results as JSON and exits with status 1 when the median import time exceeds the budget
+or a client library is imported eagerly.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Client libraries that should only be loaded once a client is first used
+LAZY_MODULES = ("langchain_openai", "openai", "pinecone", "fitz")
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("JWT_SECRET_KEY", "bench-secret")
+    env.setdefault("JWT_ALGORITHM", "HS256")
+    output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, lazy=LAZY_MODULES)], env=env,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of the API.")
+    parser.add_argument("--module", default="api.main", help="Module to import")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to measure")
+    parser.add_argument("--budget", type=float, default=None, help="Maximum median import time in seconds")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    seconds = [run["seconds"] for run in runs]
+    results = {
+        "module": args.module,
+        "median_seconds": round(statistics.median(seconds), 3),
+        "min_seconds": round(min(seconds), 3),
+        "max_seconds": round(max(seconds), 3),
+        "eagerly_loaded": runs[0]["loaded"],
+    }
+    print(json.dumps(results, indent=2))
+    if args.budget is not None and (results["median_seconds"] > args.budget or results["eagerly_loaded"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Load test for the API with Azure OpenAI, Pinecone and MongoDB replaced by in-process stand-ins.
+
+    python -m bench.run --users 50 --turns 5 --output results.json
+    python -m bench.run --baseline results.json --tolerance 0.2
+
+Prints per-endpoint latency percentiles and throughput as JSON. With --baseline, exits with status 1
+when an endpoint's p95 latency regressed by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+PROMPTS = [
+    "How do I activate an eSIM on my phone?",
+    "Which internet packages do you offer?",
+    "What roaming options are available abroad?",
+    "How can I top up my balance?",
+    "What does the unlimited package include?",
+    "Can I keep my number when switching to you?",
+]
+
+
+def configure_environment(data_dir: str):
+    """
+    Points the settings at local stand-ins. Must run before any application module is imported.
+    """
+    os.environ.setdefault("JWT_SECRET_KEY", "bench-secret")
+    os.environ.setdefault("JWT_ALGORITHM", "HS256")
+    os.environ.setdefault("JWT_EXPIRATION_SECONDS", "3600")
+    os.environ.setdefault("CONNECTION_STRINGS_MONGODB", "mongodb://localhost:27017")
+    os.environ["VECTOR_STORE_BACKEND"] = "local"
+    os.environ["VECTOR_STORE_LOCAL_PATH"] = os.path.join(data_dir, "vectors")
+    os.environ["EMBEDDING_CACHE_PATH"] = ""
+
+
+def install_fakes(args):
+    """
+    Swaps the model clients and Mongo collections of the loaded application for in-process fakes.
+
+    Returns:
+        tuple: The fake embeddings, the fake chat model and the fake collections keyed by name.
+    """
+    from application import langchain_lib, prompt_builder
+    from bench.fakes import ApproximateEncoding, FakeChatModel, FakeEmbeddings, InMemoryCollection
+    from db import database
+    from db.repositories import memory_repository, message_buckets, message_writer, text_file_repository, \
+        user_repository
+
+    embeddings = FakeEmbeddings(langchain_lib.EMBEDDING_DIMENSION, args.embedding_latency)
+    chat = FakeChatModel(args.chat_latency, args.first_token_latency)
+    langchain_lib.utils.embeddings = embeddings
+    langchain_lib.gpt = chat
+
+    try:
+        prompt_builder.get_encoding()
+    except Exception:
+        # The encoding is downloaded on first use; offline runs count whitespace-separated words instead
+        prompt_builder.get_encoding = lambda name=None: ApproximateEncoding()
+
+    collections = {name: InMemoryCollection(name)
+                   for name in ("users", "messages", "text_files", "text_chunks", "conversation_memories",
+                                "message_buckets", "message_archive")}
+    for module in (database, user_repository, text_file_repository, message_writer, memory_repository,
+                   message_buckets):
+        for name, collection in collections.items():
+            if hasattr(module, f"{name}_collection"):
+                setattr(module, f"{name}_collection", collection)
+    if message_buckets.message_buckets is not None:
+        message_buckets.message_buckets.collection = collections["message_buckets"]
+        message_buckets.message_buckets.archive_collection = collections["message_archive"]
+    if message_writer.message_writer is not None and message_buckets.message_buckets is None:
+        message_writer.message_writer.collection = collections["messages"]
+    return embeddings, chat, collections
+
+
+def seed_documents(collections: dict, embeddings):
+    """
+    Stores one document and one routing vector per configured file.
+    """
+    from bson import ObjectId
+
+    from application.langchain_lib import EMBEDDING_DIMENSION, FILES_INDEX, files_config, ph
+
+    filler = "Step by step instructions and plan details. " * 200
+    for title in dict.fromkeys(files_config.values()):
+        collections["text_files"].documents.append(
+            {"_id": ObjectId(), "title": title, "content": f"{title}. {filler}", "version": 1}
+        )
+    ph.insert_vectors(FILES_INDEX, [(vector_id, embeddings._vector(title)) for vector_id, title in files_config.items()],
+                      EMBEDDING_DIMENSION)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint: str, seconds: float, ok: bool = True):
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def summary(self, duration: float) -> dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "rps": round(len(latencies) / duration, 2),
+                "mean_ms": round(float(np.mean(latencies)) * 1000, 2),
+                "p50_ms": round(float(p50), 2),
+                "p95_ms": round(float(p95), 2),
+                "p99_ms": round(float(p99), 2),
+            }
+        return endpoints
+
+
+async def timed(recorder: Recorder, endpoint: str, request):
+    started = time.perf_counter()
+    response = await request
+    # Streams report failures as an error event after a 200 status
+    ok = response.status_code < 400 and "event: error" not in response.text
+    recorder.record(endpoint, time.perf_counter() - started, ok)
+    return response
+
+
+async def simulate_user(client, recorder: Recorder, user: int, turns: int):
+    response = await timed(recorder, "POST /auth/token", client.post("/auth/token"))
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    for turn in range(turns):
+        prompt = PROMPTS[(user + turn) % len(PROMPTS)]
+        if turn % 2:
+            # The ASGI transport buffers response bodies, so this measures the complete stream
+            await timed(recorder, "POST /process/stream",
+                        client.post("/process/stream", json={"input_text": prompt}, headers=headers))
+        else:
+            await timed(recorder, "POST /process/",
+                        client.post("/process/", json={"input_text": prompt}, headers=headers))
+        await timed(recorder, "GET /user/last_messages/{n}", client.get("/user/last_messages/10", headers=headers))
+    await timed(recorder, "GET /user/last_messages/", client.get("/user/last_messages/?limit=20", headers=headers))
+
+
+async def run(args) -> dict:
+    import httpx
+
+    from api.main import app
+
+    embeddings, chat, collections = install_fakes(args)
+    seed_documents(collections, embeddings)
+    await app.router.startup()
+    recorder = Recorder()
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            started = time.perf_counter()
+            await asyncio.gather(*(simulate_user(client, recorder, user, args.turns) for user in range(args.users)))
+            duration = time.perf_counter() - started
+    finally:
+        await app.router.shutdown()
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "tolerance", "min_delta_ms")},
+        "duration_seconds": round(duration, 3),
+        "upstream_calls": {"embeddings": embeddings.calls, "chat": chat.calls},
+        "endpoints": recorder.summary(duration),
+    }
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    regressions = []
+    for endpoint, stats in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        # Millisecond-scale endpoints jitter by more than any sensible relative tolerance
+        if previous and stats["p95_ms"] > max(previous["p95_ms"] * (1 + tolerance),
+                                              previous["p95_ms"] + min_delta_ms):
+            regressions.append(f"{endpoint}: p95 {previous['p95_ms']}ms -> {stats['p95_ms']}ms")
+        if stats["errors"] and not (previous and previous["errors"]):
+            regressions.append(f"{endpoint}: {stats['errors']} failed requests")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API against in-process stand-ins.")
+    parser.add_argument("--users", type=int, default=20, help="Number of concurrent simulated users")
+    parser.add_argument("--turns", type=int, default=4, help="Questions asked by each user")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="Seconds per embeddings call")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="Seconds per completion")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="Seconds until the first token")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative p95 increase")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="Allowed absolute p95 increase")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        configure_environment(data_dir)
+        results = asyncio.run(run(args))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from core.metrics import Counter
+
+shed_requests = Counter("app_admission_shed_total", "Upstream calls rejected because the deployment was saturated.",
+                        ("deployment",))
+rate_limited_requests = Counter("app_upstream_rate_limited_total", "Upstream calls answered with HTTP 429.",
+                                ("deployment",))
+
+
+class OverloadedError(Exception):
+    def __init__(self, deployment: str, retry_after: int):
+        super().__init__(f"Deployment '{deployment}' is overloaded, retry in {retry_after}s")
+        self.deployment = deployment
+        self.retry_after = retry_after
+
+
+def _is_rate_limit(exc: BaseException) -> bool:
+    return getattr(exc, "status_code", None) == 429
+
+
+class AdmissionController:
+    def __init__(self, deployment: str, max_concurrency: int, min_concurrency: int, max_queue: int,
+                 queue_timeout: float, target_latency: float):
+        """
+        Limits concurrent calls to one upstream deployment and queues or sheds the rest.
+
+        The concurrency limit adapts: it grows by about one per limit's worth of fast calls, shrinks by 10% when
+        a call is slower than the target latency, and halves when the deployment answers 429. Only calls that
+        started after the last decrease can decrease it again, so a burst of slow or rate-limited calls that were
+        in flight together counts once.
+
+        Args:
+            deployment (str): Name of the upstream deployment, used in errors and metrics.
+            max_concurrency (int): Initial and highest concurrency limit.
+            min_concurrency (int): Lowest concurrency limit.
+            max_queue (int): Calls allowed to wait for a slot; further calls are shed immediately.
+            queue_timeout (float): Seconds a call may wait for a slot before it is shed.
+            target_latency (float): Call latency in seconds above which the limit is reduced.
+        """
+        self.deployment = deployment
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self._waiters = deque()
+        self._last_decrease = float("-inf")
+        # Moving average of call latency, used to predict queueing delay
+        self._latency = target_latency / 2
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._expected_wait()))
+
+    def _expected_wait(self) -> float:
+        return self._latency * (len(self._waiters) + 1) / max(int(self.limit), 1)
+
+    def _shed(self):
+        shed_requests.inc(deployment=self.deployment)
+        return OverloadedError(self.deployment, self._retry_after())
+
+    def _wake(self):
+        while self._waiters and self.active < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if self.active < int(self.limit) and not self._waiters:
+            self.active += 1
+            return
+        # Shed up front when the queue is full or will not drain before the caller's deadline
+        if len(self._waiters) >= self.max_queue or self._expected_wait() > self.queue_timeout:
+            raise self._shed()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # The slot was granted just as the deadline passed
+                self.release()
+            else:
+                self._abandon(waiter)
+            raise self._shed()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: asyncio.Future):
+        waiter.cancel()
+        # Dead waiters must not count against the queue length or the expected wait
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _decrease(self, started: float, factor: float):
+        if started < self._last_decrease:
+            # The limit was already cut while this call was in flight
+            return
+        self.limit = max(float(self.min_concurrency), self.limit * factor)
+        self._last_decrease = time.monotonic()
+
+    def _record(self, started: float, rate_limited: bool):
+        latency = time.monotonic() - started
+        if rate_limited:
+            rate_limited_requests.inc(deployment=self.deployment)
+            self._decrease(started, 0.5)
+            return
+        self._latency = 0.9 * self._latency + 0.1 * latency
+        if latency > self.target_latency:
+            self._decrease(started, 0.9)
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._wake()
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Holds one of the deployment's slots for the duration of the block.
+
+        Raises:
+            OverloadedError: If no slot frees up before the queue timeout, or the queue is full.
+        """
+        await self.acquire()
+        started = time.monotonic()
+        rate_limited = False
+        try:
+            yield
+        except Exception as exc:
+            rate_limited = _is_rate_limit(exc)
+            raise
+        finally:
+            self._record(started, rate_limited)
+            self.release()
@@ -6,10 +6,32 @@ dotenv_path = dotenv.find_dotenv(filename='.env', raise_error_if_not_found=False
 dotenv.load_dotenv(dotenv_path=dotenv_path)
 
 
+def require_setting(value: str, env_name: str) -> str:
+    """
+    Returns a setting that has no default, failing with the variable to set when it is missing.
+
+    Raises:
+        RuntimeError: If the setting is unset or empty.
+    """
+    if not value:
+        raise RuntimeError(f"{env_name} is not set; add it to the environment or to .env")
+    return value
+
+
 class JwtSettings:
     SECRET_KEY: str = os.getenv("JWT_SECRET_KEY")
     ALGORITHM: str = os.getenv("JWT_ALGORITHM")
-    EXPIRATION_SECONDS: int = int(os.getenv("JWT_EXPIRATION_SECONDS"))
+    EXPIRATION_SECONDS: int = int(os.getenv("JWT_EXPIRATION_SECONDS", "3600"))
+
+
+class AuthSettings:
+    # "stateless" issues anonymous tokens without a user document, "persistent" stores one per visitor
+    ANONYMOUS_SESSION_MODE: str = os.getenv("AUTH_ANONYMOUS_SESSION_MODE", "stateless")
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("AUTH_PASSWORD_HASH_WORKERS", "2"))
+    USER_CACHE_MAX_SIZE: int = int(os.getenv("AUTH_USER_CACHE_MAX_SIZE", "10000"))
+    USER_CACHE_TTL_SECONDS: int = int(os.getenv("AUTH_USER_CACHE_TTL_SECONDS", "300"))
+    # Endpoints that only need the username take it from a valid token without loading the user
+    TRUST_TOKEN_CLAIMS: bool = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "false").lower() == "true"
 
 
 class MongoDbSettings:
@@ -17,5 +39,164 @@ class MongoDbSettings:
     MONGODB_DATABASE: str = "utechleague24-db"
 
 
+class AzureOpenAISettings:
+    # Required, checked when the first client is created
+    API_KEY: str = os.getenv("AZURE_OPENAI_API_KEY")
+    ENDPOINT: str = os.getenv("AZURE_OPENAI_ENDPOINT", "https://uleague-openai.openai.azure.com/")
+    API_VERSION: str = os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-01")
+    CHAT_DEPLOYMENT: str = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT", "gpt3")
+    CHAT_MODEL_VERSION: str = os.getenv("AZURE_OPENAI_CHAT_MODEL_VERSION", "0613")
+    EMBEDDING_DEPLOYMENT: str = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "emb_model")
+    REQUEST_TIMEOUT_SECONDS: float = float(os.getenv("AZURE_OPENAI_REQUEST_TIMEOUT_SECONDS", "30"))
+    MAX_RETRIES: int = int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "2"))
+
+
+class VectorStoreSettings:
+    BACKEND: str = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+    LOCAL_PATH: str = os.getenv("VECTOR_STORE_LOCAL_PATH", "data/vectors")
+
+
+class PineconeSettings:
+    # Required by the pinecone backend, checked when the client is created
+    API_KEY: str = os.getenv("CONNECTION_STRINGS_PINECONE")
+    UPSERT_BATCH_SIZE: int = int(os.getenv("PINECONE_UPSERT_BATCH_SIZE", "100"))
+    DELETE_BATCH_SIZE: int = int(os.getenv("PINECONE_DELETE_BATCH_SIZE", "1000"))
+    FETCH_BATCH_SIZE: int = int(os.getenv("PINECONE_FETCH_BATCH_SIZE", "100"))
+    BATCH_CONCURRENCY: int = int(os.getenv("PINECONE_BATCH_CONCURRENCY", "4"))
+    # Users' vectors are namespaces of this index; names in DEDICATED_INDEXES keep an index of their own
+    SHARED_INDEX: str = os.getenv("PINECONE_SHARED_INDEX", "user-vectors")
+    DEDICATED_INDEXES: frozenset = frozenset(
+        name.strip() for name in os.getenv("PINECONE_DEDICATED_INDEXES", "files").split(",") if name.strip())
+
+
+class EmbeddingCacheSettings:
+    MAX_SIZE: int = int(os.getenv("EMBEDDING_CACHE_MAX_SIZE", "10000"))
+    TTL_SECONDS: int = int(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+    PATH: str = os.getenv("EMBEDDING_CACHE_PATH", "data/embeddings.sqlite3")
+
+
+class AnswerCacheSettings:
+    ENABLED: bool = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+    SIMILARITY_THRESHOLD: float = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95"))
+    MAX_SIZE: int = int(os.getenv("ANSWER_CACHE_MAX_SIZE", "1000"))
+    TTL_SECONDS: int = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+
+
+class RetrievalSettings:
+    HISTORY_TIMEOUT_SECONDS: float = float(os.getenv("RETRIEVAL_HISTORY_TIMEOUT_SECONDS", "2"))
+    EMBEDDING_TIMEOUT_SECONDS: float = float(os.getenv("RETRIEVAL_EMBEDDING_TIMEOUT_SECONDS", "5"))
+    VECTOR_QUERY_TIMEOUT_SECONDS: float = float(os.getenv("RETRIEVAL_VECTOR_QUERY_TIMEOUT_SECONDS", "3"))
+    DOCUMENT_TIMEOUT_SECONDS: float = float(os.getenv("RETRIEVAL_DOCUMENT_TIMEOUT_SECONDS", "2"))
+    TOP_K: int = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+    # Route keyword-obvious prompts with BM25 and skip the embedding call
+    LEXICAL_ROUTING_ENABLED: bool = os.getenv("RETRIEVAL_LEXICAL_ROUTING_ENABLED", "false").lower() == "true"
+    LEXICAL_MIN_SCORE: float = float(os.getenv("RETRIEVAL_LEXICAL_MIN_SCORE", "1.5"))
+    LEXICAL_MIN_MARGIN: float = float(os.getenv("RETRIEVAL_LEXICAL_MIN_MARGIN", "0.4"))
+    HYBRID_VECTOR_WEIGHT: float = float(os.getenv("RETRIEVAL_HYBRID_VECTOR_WEIGHT", "0.7"))
+
+
+class PromptSettings:
+    MAX_TOKENS: int = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+    QUESTION_MAX_TOKENS: int = int(os.getenv("PROMPT_QUESTION_MAX_TOKENS", "300"))
+    HISTORY_MAX_TOKENS: int = int(os.getenv("PROMPT_HISTORY_MAX_TOKENS", "600"))
+    SUMMARY_MAX_TOKENS: int = int(os.getenv("PROMPT_SUMMARY_MAX_TOKENS", "200"))
+    TOKENIZER_ENCODING: str = os.getenv("PROMPT_TOKENIZER_ENCODING", "cl100k_base")
+
+
+class TextFileCacheSettings:
+    MAX_BYTES: int = int(os.getenv("TEXT_FILE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    POLL_INTERVAL_SECONDS: float = float(os.getenv("TEXT_FILE_CACHE_POLL_INTERVAL_SECONDS", "30"))
+
+
+class MessageWriterSettings:
+    WRITE_BEHIND: bool = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+    MAX_BATCH: int = int(os.getenv("MESSAGE_WRITE_BEHIND_MAX_BATCH", "100"))
+    FLUSH_INTERVAL_SECONDS: float = float(os.getenv("MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", "0.5"))
+    MAX_PENDING: int = int(os.getenv("MESSAGE_WRITE_BEHIND_MAX_PENDING", "10000"))
+    # Failed writes after which a buffered message is dropped and logged
+    MAX_ATTEMPTS: int = int(os.getenv("MESSAGE_WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+
+
+class MessageStorageSettings:
+    # "documents" stores one document per message; "buckets" groups each user's messages into bucket documents
+    MODE: str = os.getenv("MESSAGE_STORAGE_MODE", "documents")
+    BUCKET_SIZE: int = int(os.getenv("MESSAGE_STORAGE_BUCKET_SIZE", "50"))
+    # Anonymous users' messages expire this long after they were written; 0 keeps them
+    ANONYMOUS_TTL_SECONDS: int = int(os.getenv("MESSAGE_STORAGE_ANONYMOUS_TTL_SECONDS", "0"))
+    # Buckets without writes for this long are moved to the archive collection; 0 disables archiving
+    ARCHIVE_AFTER_DAYS: float = float(os.getenv("MESSAGE_STORAGE_ARCHIVE_AFTER_DAYS", "0"))
+    COMPACTION_INTERVAL_SECONDS: float = float(os.getenv("MESSAGE_STORAGE_COMPACTION_INTERVAL_SECONDS", "3600"))
+
+
+class BatchSettings:
+    MAX_PROMPTS: int = int(os.getenv("BATCH_MAX_PROMPTS", "100"))
+    # Completions a batch runs at once; they also count against the chat admission limit
+    CONCURRENCY: int = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+
+class UserMemorySettings:
+    # Embed users' messages in the background so their past messages can be recalled by similarity
+    ENABLED: bool = os.getenv("USER_MEMORY_ENABLED", "false").lower() == "true"
+    MAX_BATCH: int = int(os.getenv("USER_MEMORY_MAX_BATCH", "64"))
+    FLUSH_INTERVAL_SECONDS: float = float(os.getenv("USER_MEMORY_FLUSH_INTERVAL_SECONDS", "2"))
+    MAX_PENDING: int = int(os.getenv("USER_MEMORY_MAX_PENDING", "10000"))
+    TOP_K: int = int(os.getenv("USER_MEMORY_TOP_K", "3"))
+
+
+class MemorySettings:
+    # Summarize older turns into a per-user rolling summary instead of sending only the last message
+    SUMMARY_ENABLED: bool = os.getenv("MEMORY_SUMMARY_ENABLED", "false").lower() == "true"
+    RECENT_MESSAGES: int = int(os.getenv("MEMORY_RECENT_MESSAGES", "4"))
+    FOLD_BATCH: int = int(os.getenv("MEMORY_FOLD_BATCH", "4"))
+    MAX_FOLD: int = int(os.getenv("MEMORY_MAX_FOLD", "40"))
+
+
+class AdmissionSettings:
+    # Concurrency limits start at the maximum and adapt between the minimum and maximum
+    CHAT_MAX_CONCURRENCY: int = int(os.getenv("ADMISSION_CHAT_MAX_CONCURRENCY", "16"))
+    EMBEDDING_MAX_CONCURRENCY: int = int(os.getenv("ADMISSION_EMBEDDING_MAX_CONCURRENCY", "32"))
+    MIN_CONCURRENCY: int = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "2"))
+    MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+    QUEUE_TIMEOUT_SECONDS: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "2"))
+    CHAT_TARGET_LATENCY_SECONDS: float = float(os.getenv("ADMISSION_CHAT_TARGET_LATENCY_SECONDS", "8"))
+    EMBEDDING_TARGET_LATENCY_SECONDS: float = float(os.getenv("ADMISSION_EMBEDDING_TARGET_LATENCY_SECONDS", "1"))
+
+
+class StartupSettings:
+    # Send one embedding request during warm-up so the first user request finds an open connection
+    WARM_UP_UPSTREAM: bool = os.getenv("STARTUP_WARM_UP_UPSTREAM", "true").lower() == "true"
+
+
+class SnapshotSettings:
+    # Serve routing vectors and document text from a memory-mapped snapshot shared by all worker processes
+    ENABLED: bool = os.getenv("SNAPSHOT_ENABLED", "false").lower() == "true"
+    PATH: str = os.getenv("SNAPSHOT_PATH", "data/snapshot")
+    POLL_INTERVAL_SECONDS: float = float(os.getenv("SNAPSHOT_POLL_INTERVAL_SECONDS", "5"))
+    KEEP_VERSIONS: int = int(os.getenv("SNAPSHOT_KEEP_VERSIONS", "3"))
+
+
+class MetricsSettings:
+    # Server-Timing exposes stage durations to clients; turn it off if that is not wanted
+    SERVER_TIMING: bool = os.getenv("METRICS_SERVER_TIMING", "true").lower() == "true"
+
+
 jwt_settings = JwtSettings()
+auth_settings = AuthSettings()
 mongodb_settings = MongoDbSettings()
+azure_openai_settings = AzureOpenAISettings()
+vector_store_settings = VectorStoreSettings()
+pinecone_settings = PineconeSettings()
+embedding_cache_settings = EmbeddingCacheSettings()
+answer_cache_settings = AnswerCacheSettings()
+retrieval_settings = RetrievalSettings()
+prompt_settings = PromptSettings()
+text_file_cache_settings = TextFileCacheSettings()
+message_writer_settings = MessageWriterSettings()
+message_storage_settings = MessageStorageSettings()
+batch_settings = BatchSettings()
+memory_settings = MemorySettings()
+user_memory_settings = UserMemorySettings()
+admission_settings = AdmissionSettings()
+startup_settings = StartupSettings()
+snapshot_settings = SnapshotSettings()
+metrics_settings = MetricsSettings()
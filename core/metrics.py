@@ -0,0 +1,232 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+# Stage name -> accumulated seconds for the current request, reported as Server-Timing
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        """
+        Monotonic counter rendered in the Prometheus text format.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The HELP text.
+            labelnames (tuple): Names of the labels passed to inc().
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """
+        Latency histogram rendered in the Prometheus text format.
+
+        Observations only increment one bucket; cumulative counts are computed when rendering.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The HELP text.
+            labelnames (tuple): Names of the labels passed to observe().
+            buckets (tuple): Upper bounds of the buckets, in ascending order.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Bucket counts (the last one is +Inf), then the sum of observations
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[position] += 1
+            state[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class CallbackCounter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...]):
+        """
+        Counter whose values are read from existing statistics when the metrics are scraped.
+
+        Args:
+            name (str): The metric name.
+            documentation (str): The HELP text.
+            labelnames (tuple): Names of the labels of each sample.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._sources: List[Callable[[], Iterable[Tuple[tuple, float]]]] = []
+        _metrics.append(self)
+
+    def add_source(self, source: Callable[[], Iterable[Tuple[tuple, float]]]):
+        """
+        Registers a function returning (label values, value) samples.
+        """
+        self._sources.append(source)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for source in self._sources:
+            lines.extend(f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in source())
+        return lines
+
+
+stage_duration = Histogram("app_stage_duration_seconds", "Time spent in each stage of request handling.", ("stage",))
+request_duration = Histogram("app_http_request_duration_seconds", "HTTP request latency until the response starts.",
+                             ("method", "route", "status"))
+llm_tokens = Counter("app_llm_tokens_total", "Tokens sent to and received from the language model.",
+                     ("deployment", "direction"))
+cache_requests = CallbackCounter("app_cache_requests_total", "Cache lookups by cache and result.",
+                                 ("cache", "result"))
+
+
+def record_stage(name: str, seconds: float):
+    stage_duration.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a block as a request-handling stage.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def timed_stage(name: str):
+    """
+    Decorator timing every call of a coroutine function as a request-handling stage.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_token_usage(deployment: str, message):
+    """
+    Counts the tokens reported in a model response's usage metadata, if any.
+    """
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        llm_tokens.inc(usage.get("input_tokens", 0), deployment=deployment, direction="input")
+        llm_tokens.inc(usage.get("output_tokens", 0), deployment=deployment, direction="output")
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+class MetricsMiddleware:
+    def __init__(self, app, server_timing: bool = True):
+        """
+        ASGI middleware recording request latency and adding the request's stage timings as a Server-Timing header.
+
+        Args:
+            app: The wrapped ASGI application.
+            server_timing (bool): Whether to send the Server-Timing header.
+        """
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                request_duration.observe(time.perf_counter() - started, method=scope["method"],
+                                         route=route.path if route is not None else "unmatched",
+                                         status=message["status"])
+                if self.server_timing and timings:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", format_server_timing(timings).encode("latin-1"))
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
@@ -1,10 +1,17 @@
-from core.config import jwt_settings
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from core.config import jwt_settings, auth_settings
 from datetime import datetime, timedelta
 from passlib.context import CryptContext
 import jwt
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt is CPU-bound; a small dedicated pool keeps it off the event loop and caps how many cores it can take
+_hash_executor = ThreadPoolExecutor(max_workers=auth_settings.PASSWORD_HASH_WORKERS,
+                                    thread_name_prefix="password-hash")
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -14,6 +21,16 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def averify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, verify_password, plain_password, hashed_password)
+
+
+async def aget_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from core.metrics import Counter
+
+T = TypeVar("T")
+
+coalesced_calls = Counter("app_coalesced_calls_total", "Calls served by joining identical work already in flight.",
+                          ("operation",))
+
+
+class SingleFlight:
+    def __init__(self, operation: str):
+        """
+        Coalesces concurrent calls with the same key into one in-flight task.
+
+        Args:
+            operation (str): Name of the coalesced operation, used as the metrics label.
+        """
+        self.operation = operation
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved in case every caller gave up waiting
+            task.exception()
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        Runs factory() unless a call with the same key is already running, in which case its result is shared.
+
+        Callers that are cancelled or time out stop waiting without cancelling the work other callers share.
+
+        Args:
+            key: Identifies equivalent work.
+            factory: Creates the coroutine doing the work.
+
+        Returns:
+            The result of the shared call. Its exception is raised to every caller.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            coalesced_calls.inc(operation=self.operation)
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
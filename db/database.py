@@ -1,5 +1,5 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from core.config import mongodb_settings
+from core.config import mongodb_settings, message_storage_settings
 
 client = AsyncIOMotorClient(mongodb_settings.MONGODB_URL)
 database = client[mongodb_settings.MONGODB_DATABASE]
@@ -7,6 +7,10 @@ database = client[mongodb_settings.MONGODB_DATABASE]
 users_collection = database.get_collection("users")
 messages_collection = database.get_collection("messages")
 text_files_collection = database.get_collection("text_files")
+text_chunks_collection = database.get_collection("text_chunks")
+conversation_memories_collection = database.get_collection("conversation_memories")
+message_buckets_collection = database.get_collection("message_buckets")
+message_archive_collection = database.get_collection("message_archive")
 
 
 # Startup tasks
@@ -16,5 +20,17 @@ async def initialize_database():
 
 async def create_indexes():
     await users_collection.create_index("username", unique=True)
-    await messages_collection.create_index("sender", unique=False)
+    await messages_collection.create_index([("sender", 1), ("createdAt", -1), ("_id", -1)], unique=False)
+    # Documents carrying an expiresAt date (anonymous users' messages, when a TTL is configured) expire on their own
+    await messages_collection.create_index("expiresAt", expireAfterSeconds=0)
+    if message_storage_settings.MODE == "buckets":
+        await message_buckets_collection.create_index([("sender", 1), ("last_at", -1)], unique=False)
+        await message_buckets_collection.create_index("last_at", unique=False)
+        # Rejects a bucket repeating messages already stored, which makes retried appends idempotent
+        await message_buckets_collection.create_index("messages._id", unique=True)
+        await message_buckets_collection.create_index("expiresAt", expireAfterSeconds=0)
+        await message_archive_collection.create_index("sender", unique=False)
     await text_files_collection.create_index("title", unique=True)
+    await text_chunks_collection.create_index([("title", 1), ("position", 1)], unique=False)
+    await conversation_memories_collection.create_index("username", unique=True)
+    await conversation_memories_collection.create_index("expiresAt", expireAfterSeconds=0)
@@ -0,0 +1,17 @@
+from datetime import datetime
+from typing import Optional
+from pydantic import BaseModel, Field
+from bson import ObjectId
+
+
+class ConversationMemory(BaseModel):
+    memoryId: str = Field(default_factory=lambda: str(ObjectId()), alias='_id')
+    username: str
+    summary: str = ""
+    summarized_until: Optional[datetime] = None
+    updatedAt: Optional[datetime] = None
+
+    class Config:
+        json_encoders = {
+            ObjectId: str
+        }
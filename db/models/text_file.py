@@ -1,3 +1,4 @@
+from typing import List, Optional
 from pydantic import BaseModel, Field
 from bson import ObjectId
 
@@ -6,6 +7,10 @@ class TextFile(BaseModel):
     fileId: str = Field(default_factory=lambda: str(ObjectId()), alias='_id')
     title: str
     content: str
+    source: Optional[str] = None
+    content_hash: Optional[str] = None
+    vector_ids: List[str] = []
+    version: int = 0
 
     class Config:
         json_encoders = {
@@ -3,6 +3,9 @@ from pydantic import BaseModel, Field
 from .message import Message
 from bson import ObjectId
 
+# Usernames handed out by /auth/token to visitors without an account
+ANONYMOUS_USERNAME_PREFIX = "user_"
+
 
 class User(BaseModel):
     userId: str = Field(default_factory=lambda: str(ObjectId()), alias='_id')
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from core.config import message_storage_settings
+from db.database import conversation_memories_collection
+from db.models.conversation_memory import ConversationMemory
+from db.models.user import ANONYMOUS_USERNAME_PREFIX
+
+
+async def get_conversation_memory(username: str) -> Optional[ConversationMemory]:
+    memory = await conversation_memories_collection.find_one({"username": username})
+    if memory:
+        memory['memoryId'] = str(memory.pop('_id'))
+        return ConversationMemory(**memory)
+    return None
+
+
+async def save_conversation_memory(username: str, summary: str, summarized_until: datetime):
+    fields = {"summary": summary, "summarized_until": summarized_until, "updatedAt": datetime.utcnow()}
+    if message_storage_settings.ANONYMOUS_TTL_SECONDS and username.startswith(ANONYMOUS_USERNAME_PREFIX):
+        # The summary expires together with the messages it covers
+        fields["expiresAt"] = fields["updatedAt"] + timedelta(seconds=message_storage_settings.ANONYMOUS_TTL_SECONDS)
+    await conversation_memories_collection.update_one({"username": username}, {"$set": fields}, upsert=True)
+
+
+async def delete_conversation_memory(username: str) -> bool:
+    result = await conversation_memories_collection.delete_one({"username": username})
+    return result.deleted_count > 0
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from core.config import message_storage_settings
+from db.database import message_buckets_collection, message_archive_collection
+from db.models.user import ANONYMOUS_USERNAME_PREFIX
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH_SIZE = 500
+DUPLICATE_KEY_ERROR = 11000
+# Stored once per bucket rather than per message
+BUCKET_LEVEL_FIELDS = ("sender", "messageId")
+
+
+def _message_key(message: dict) -> Tuple[datetime, ObjectId]:
+    return message["createdAt"], message["_id"]
+
+
+def _unpack(bucket: dict) -> List[dict]:
+    return [{**message, "sender": bucket["sender"]} for message in bucket["messages"]]
+
+
+class MessageBucketStore:
+    def __init__(self, collection, archive_collection, bucket_size: int, anonymous_ttl: float, archive_after: float,
+                 compaction_interval: float):
+        """
+        Stores each user's messages in bucket documents of up to bucket_size messages.
+
+        Recent history is a single indexed read of the newest bucket or two instead of one document per message.
+        Buckets of anonymous users expire anonymous_ttl seconds after their last write, and buckets nobody has
+        written to for archive_after seconds are moved to the archive collection by a background job.
+
+        Args:
+            collection: The Mongo collection holding the live buckets.
+            archive_collection: The Mongo collection old buckets are moved to.
+            bucket_size (int): Maximum number of messages per bucket.
+            anonymous_ttl (float): Seconds anonymous users' buckets are kept after their last write. 0 keeps them.
+            archive_after (float): Seconds without writes after which a bucket is archived. 0 disables archiving.
+            compaction_interval (float): Seconds between archiving runs.
+        """
+        self.collection = collection
+        self.archive_collection = archive_collection
+        self.bucket_size = bucket_size
+        self.anonymous_ttl = anonymous_ttl
+        self.archive_after = archive_after
+        self.compaction_interval = compaction_interval
+        self._task: Optional[asyncio.Task] = None
+
+    def _append(self, sender: str, messages: List[dict]) -> UpdateOne:
+        last_at = max(message["createdAt"] for message in messages)
+        # $min and $max keep the bounds right when buffers of several workers flush out of order
+        update = {
+            "$push": {"messages": {"$each": [{key: value for key, value in message.items()
+                                              if key not in BUCKET_LEVEL_FIELDS} for message in messages]}},
+            "$inc": {"count": len(messages)},
+            "$max": {"last_at": last_at},
+            "$min": {"first_at": min(message["createdAt"] for message in messages)},
+        }
+        if self.anonymous_ttl and sender.startswith(ANONYMOUS_USERNAME_PREFIX):
+            update["$max"]["expiresAt"] = last_at + timedelta(seconds=self.anonymous_ttl)
+        # Fills the sender's open bucket, or starts a new one when no bucket has room for the whole batch. A bucket
+        # already holding these messages is never appended to again, and the unique index on messages._id rejects
+        # a new bucket repeating them, so a retried append cannot store a message twice.
+        return UpdateOne({"sender": sender, "count": {"$lte": self.bucket_size - len(messages)},
+                          "messages._id": {"$nin": [message["_id"] for message in messages]}}, update, upsert=True)
+
+    async def insert_many(self, messages: List[dict], ordered: bool = True):
+        """
+        Appends messages to their senders' buckets in one bulk write, so the store can stand in for the
+        messages collection of the write-behind buffer.
+
+        Messages that are already stored are skipped, so retrying a batch is safe.
+
+        Raises:
+            BulkWriteError: If some appends failed. Like an insert_many, the write errors carry the positions of
+                the failed messages in `messages`.
+        """
+        by_sender: Dict[str, List[int]] = {}
+        for position, message in enumerate(messages):
+            by_sender.setdefault(message["sender"], []).append(position)
+        groups = [positions[start:start + self.bucket_size]
+                  for positions in by_sender.values() for start in range(0, len(positions), self.bucket_size)]
+        if not groups:
+            return
+        try:
+            await self.collection.bulk_write([self._append(messages[group[0]]["sender"],
+                                                           [messages[position] for position in group])
+                                              for group in groups], ordered=ordered)
+            return
+        except BulkWriteError as exc:
+            errors = exc.details.get("writeErrors", [])
+        # A new bucket repeating stored messages was rejected; the append may mix stored and new messages
+        conflicting = [position for error in errors if error.get("code") == DUPLICATE_KEY_ERROR
+                       for position in groups[error["index"]]]
+        failed = [{**error, "index": position} for error in errors if error.get("code") != DUPLICATE_KEY_ERROR
+                  for position in groups[error["index"]]]
+        if conflicting:
+            try:
+                await self._insert_unstored([messages[position] for position in conflicting])
+            except PyMongoError as exc:
+                failed.extend({"index": position, "code": getattr(exc, "code", None), "errmsg": str(exc)}
+                              for position in conflicting)
+        if failed:
+            raise BulkWriteError({"writeErrors": failed, "nInserted": 0})
+
+    async def _insert_unstored(self, messages: List[dict]):
+        ids = [message["_id"] for message in messages]
+        stored = set()
+        async for bucket in self.collection.find({"messages._id": {"$in": ids}}, {"messages._id": 1}):
+            stored.update(message["_id"] for message in bucket["messages"])
+        unstored = [message for message in messages if message["_id"] not in stored]
+        if unstored:
+            await self.insert_many(unstored)
+
+    async def insert_one(self, message: dict):
+        await self.insert_many([message])
+
+    async def latest(self, sender: str, limit: int = 0, skip: int = 0,
+                     before: Optional[Tuple[datetime, ObjectId]] = None) -> List[dict]:
+        """
+        Returns the sender's messages newest first, reading only as many buckets as the page needs.
+
+        Args:
+            sender (str): The username.
+            limit (int): Maximum number of messages. 0 returns all of them.
+            skip (int): Number of newest messages to leave out.
+            before (tuple): (createdAt, _id) cursor; only older messages are returned.
+
+        Returns:
+            list: The messages, newest first.
+        """
+        query = {"sender": sender}
+        if before is not None:
+            query["first_at"] = {"$lte": before[0]}
+        needed = skip + limit if limit else 0
+        collected = []
+        async for bucket in self.collection.find(query).sort("last_at", -1):
+            # Buckets are read newest first; once the page is full, a bucket ending before its oldest
+            # message cannot contribute
+            if needed and len(collected) >= needed and bucket["last_at"] < collected[needed - 1]["createdAt"]:
+                break
+            collected.extend(message for message in _unpack(bucket)
+                             if before is None or _message_key(message) < before)
+            collected.sort(key=_message_key, reverse=True)
+        collected = collected[skip:]
+        return collected[:limit] if limit else collected
+
+    async def since(self, sender: str, since: Optional[datetime] = None, limit: int = 0) -> List[dict]:
+        """
+        Returns the sender's oldest messages created after the given time, oldest first.
+        """
+        query = {"sender": sender}
+        if since is not None:
+            query["last_at"] = {"$gt": since}
+        collected = []
+        async for bucket in self.collection.find(query).sort("first_at", 1):
+            if limit and len(collected) >= limit and bucket["first_at"] > collected[limit - 1]["createdAt"]:
+                break
+            collected.extend(message for message in _unpack(bucket)
+                             if since is None or message["createdAt"] > since)
+            collected.sort(key=_message_key)
+        return collected[:limit] if limit else collected
+
+    async def delete_sender(self, sender: str) -> int:
+        """
+        Deletes the sender's live and archived buckets.
+
+        Returns:
+            int: The number of messages deleted from the live buckets.
+        """
+        deleted = sum([bucket["count"] async for bucket in self.collection.find({"sender": sender}, {"count": 1})])
+        await self.collection.delete_many({"sender": sender})
+        await self.archive_collection.delete_many({"sender": sender})
+        return deleted
+
+    async def archive(self, older_than: datetime) -> int:
+        """
+        Moves buckets without writes since the given time to the archive collection, a batch at a time.
+
+        Returns:
+            int: The number of buckets archived.
+        """
+        archived = 0
+        while True:
+            buckets = await self.collection.find({"last_at": {"$lt": older_than}}) \
+                .limit(ARCHIVE_BATCH_SIZE).to_list(length=ARCHIVE_BATCH_SIZE)
+            if not buckets:
+                return archived
+            # Replacing by _id keeps the copy idempotent when several workers archive at once
+            await self.archive_collection.bulk_write([ReplaceOne({"_id": bucket["_id"]}, bucket, upsert=True)
+                                                      for bucket in buckets], ordered=False)
+            # A bucket written to since it was read no longer matches and stays live
+            await self.collection.delete_many({"$or": [{"_id": bucket["_id"], "last_at": bucket["last_at"]}
+                                                       for bucket in buckets]})
+            archived += len(buckets)
+            if len(buckets) < ARCHIVE_BATCH_SIZE:
+                return archived
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            try:
+                archived = await self.archive(datetime.utcnow() - timedelta(seconds=self.archive_after))
+                if archived:
+                    logger.info("Archived %d message buckets", archived)
+            except PyMongoError:
+                logger.exception("Failed to archive message buckets")
+
+    def start(self):
+        if self.archive_after and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+message_buckets = None
+if message_storage_settings.MODE == "buckets":
+    message_buckets = MessageBucketStore(
+        message_buckets_collection,
+        message_archive_collection,
+        bucket_size=message_storage_settings.BUCKET_SIZE,
+        anonymous_ttl=message_storage_settings.ANONYMOUS_TTL_SECONDS,
+        archive_after=message_storage_settings.ARCHIVE_AFTER_DAYS * 86400,
+        compaction_interval=message_storage_settings.COMPACTION_INTERVAL_SECONDS
+    )
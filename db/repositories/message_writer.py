@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from core.config import message_writer_settings
+from db.database import messages_collection
+from db.repositories.message_buckets import message_buckets
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class MessageWriter:
+    def __init__(self, collection, max_batch: int, flush_interval: float, max_pending: int, max_attempts: int):
+        """
+        Buffers message inserts in memory and writes them to Mongo in batches.
+
+        Args:
+            collection: The Mongo collection, or the bucket store, the messages are written to.
+            max_batch (int): Number of queued messages that triggers an immediate flush.
+            flush_interval (float): Seconds between background flushes.
+            max_pending (int): Queue size at which enqueueing waits for a flush instead of growing further.
+            max_attempts (int): Failed writes after which a message is dropped with an error, so one bad row
+                cannot be retried forever.
+        """
+        self.collection = collection
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._pending: List[dict] = []
+        self._by_sender: Dict[str, List[dict]] = {}
+        self._attempts: Dict[ObjectId, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def enqueue(self, message: dict):
+        self._pending.append(message)
+        self._by_sender.setdefault(message["sender"], []).append(message)
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+        elif len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def pending_for(self, sender: str) -> List[dict]:
+        """
+        Returns the sender's messages that are queued but not yet written, oldest first.
+        """
+        return list(self._by_sender.get(sender, ()))
+
+    def discard(self, sender: str):
+        dropped = self._by_sender.pop(sender, [])
+        if dropped:
+            dropped_ids = {id(message) for message in dropped}
+            self._pending = [message for message in self._pending if id(message) not in dropped_ids]
+            for message in dropped:
+                self._attempts.pop(message["_id"], None)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._pending
+            self._pending = []
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+                written = batch
+            except BulkWriteError as exc:
+                # Rows that went in, or were already stored by an earlier unacknowledged attempt, are done
+                failed = {error["index"] for error in exc.details.get("writeErrors", [])
+                          if error.get("code") != DUPLICATE_KEY_ERROR}
+                retry = [message for position, message in enumerate(batch) if position in failed]
+                written = [message for position, message in enumerate(batch) if position not in failed]
+                if retry:
+                    logger.error("Failed to write %d of %d buffered messages, will retry", len(retry), len(batch))
+                    written += self._requeue(retry)
+            except PyMongoError:
+                logger.exception("Failed to write %d buffered messages, will retry", len(batch))
+                written = self._requeue(batch)
+            self._forget(written)
+
+    def _requeue(self, failed: List[dict]) -> List[dict]:
+        """
+        Puts failed messages back at the head of the queue, and returns those that ran out of attempts.
+        """
+        retry, dropped = [], []
+        for message in failed:
+            attempts = self._attempts.get(message["_id"], 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[message["_id"]] = attempts
+                retry.append(message)
+            else:
+                dropped.append(message)
+        if dropped:
+            logger.error("Dropping %d buffered messages after %d failed writes: %s", len(dropped), self.max_attempts,
+                         ", ".join(message["messageId"] for message in dropped))
+        self._pending = retry + self._pending
+        return dropped
+
+    def _forget(self, messages: List[dict]):
+        # Messages stay readable from the buffer until the insert is acknowledged or they are dropped
+        for message in messages:
+            self._attempts.pop(message["_id"], None)
+            queued = self._by_sender.get(message["sender"])
+            if queued:
+                queued.remove(message)
+                if not queued:
+                    del self._by_sender[message["sender"]]
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+message_writer = None
+if message_writer_settings.WRITE_BEHIND:
+    message_writer = MessageWriter(
+        message_buckets if message_buckets is not None else messages_collection,
+        max_batch=message_writer_settings.MAX_BATCH,
+        flush_interval=message_writer_settings.FLUSH_INTERVAL_SECONDS,
+        max_pending=message_writer_settings.MAX_PENDING,
+        max_attempts=message_writer_settings.MAX_ATTEMPTS
+    )
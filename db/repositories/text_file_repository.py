@@ -1,22 +1,255 @@
-from typing import Optional
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
 from bson import ObjectId
-from db.database import text_files_collection
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from core.cache import SizeBoundedCache
+from core.config import text_file_cache_settings
+from core.metrics import timed_stage, cache_requests
+from db.database import text_files_collection, text_chunks_collection
 from db.models.text_file import TextFile
 
+logger = logging.getLogger(__name__)
+_change_listeners: List[Callable[[str], None]] = []
+
+# Documents and chunks share one byte budget; hot-path context lookups are served from here
+_cache = SizeBoundedCache(text_file_cache_settings.MAX_BYTES)
+_chunk_ids_by_title: Dict[str, set] = {}
+_missing_chunk_ids = set()
+# _id -> (title, version) of every stored document, used to detect changes made by other processes
+_known_documents: Dict[ObjectId, tuple] = {}
+_watcher_task: Optional[asyncio.Task] = None
+
+
+def add_text_file_listener(listener: Callable[[str], None]):
+    _change_listeners.append(listener)
+
+
+def _notify_text_file_changed(title: str):
+    _cache.pop(("text_file", title))
+    for chunk_id in _chunk_ids_by_title.pop(title, ()):
+        _cache.pop(("chunk", chunk_id))
+    _missing_chunk_ids.clear()
+    for listener in _change_listeners:
+        try:
+            listener(title)
+        except Exception:
+            # One failing listener must not keep the others, or the watcher, from seeing later changes
+            logger.exception("Text file listener failed for %s", title)
+
+
+def _invalidate_all_text_files():
+    titles = {title for title, _ in _known_documents.values()}
+    titles.update(_chunk_ids_by_title)
+    _cache.clear()
+    _chunk_ids_by_title.clear()
+    _known_documents.clear()
+    for title in titles:
+        _notify_text_file_changed(title)
+
+
+def _to_text_file(pdf_file: dict) -> TextFile:
+    pdf_file['fileId'] = str(pdf_file.pop('_id'))
+    return TextFile(**pdf_file)
+
+
+def _cache_text_file(text_file: TextFile):
+    _cache.set(("text_file", text_file.title), text_file, len(text_file.content.encode("utf-8")))
+
+
+def _cache_chunk(chunk: dict):
+    _cache.set(("chunk", chunk["_id"]), chunk, len(chunk["content"].encode("utf-8")))
+    _chunk_ids_by_title.setdefault(chunk["title"], set()).add(chunk["_id"])
+
 
 async def create_text_file(title: str, content: str) -> str:
     pdf_file_dict = {
         "title": title,
         "content": content,
+        "version": 1,
         "_id": ObjectId()
     }
     result = await text_files_collection.insert_one(pdf_file_dict)
+    _notify_text_file_changed(title)
     return str(result.inserted_id)
 
 
+async def update_text_file(title: str, content: str) -> bool:
+    result = await text_files_collection.update_one({"title": title},
+                                                    {"$set": {"content": content}, "$inc": {"version": 1}})
+    _notify_text_file_changed(title)
+    return result.matched_count > 0
+
+
+@timed_stage("text_file_lookup")
 async def find_text_by_title(title: str) -> Optional[TextFile]:
+    text_file = _cache.get(("text_file", title))
+    if text_file is not None:
+        return text_file
     pdf_file = await text_files_collection.find_one({"title": title})
     if pdf_file:
-        pdf_file['fileId'] = str(pdf_file.pop('_id'))
-        return TextFile(**pdf_file)
+        text_file = _to_text_file(pdf_file)
+        _cache_text_file(text_file)
+        return text_file
     return None
+
+
+async def get_text_file_hashes() -> Dict[str, Optional[str]]:
+    cursor = text_files_collection.find({}, {"title": 1, "content_hash": 1, "_id": 0})
+    return {text_file["title"]: text_file.get("content_hash") async for text_file in cursor}
+
+
+async def get_document_routes() -> List[dict]:
+    cursor = text_files_collection.find({"vector_ids.0": {"$exists": True}},
+                                        {"title": 1, "source": 1, "vector_ids": 1, "_id": 0})
+    return await cursor.to_list(length=None)
+
+
+async def bulk_upsert_text_files(text_files: List[dict]) -> int:
+    if not text_files:
+        return 0
+    result = await text_files_collection.bulk_write(
+        [UpdateOne({"title": text_file["title"]}, {"$set": text_file, "$inc": {"version": 1}}, upsert=True)
+         for text_file in text_files],
+        ordered=False
+    )
+    for text_file in text_files:
+        _notify_text_file_changed(text_file["title"])
+    return result.upserted_count + result.modified_count
+
+
+async def get_routing_corpus() -> Tuple[List[dict], List[dict]]:
+    """
+    Loads the text of every document and chunk for building the lexical routing index or a routing snapshot.
+
+    Returns:
+        tuple: The documents (title, content, source, vector_ids) and the chunks (_id, title, content).
+    """
+    text_files = await text_files_collection.find({}, {"title": 1, "content": 1, "source": 1, "vector_ids": 1,
+                                                       "_id": 0}).to_list(length=None)
+    chunks = await text_chunks_collection.find({}, {"title": 1, "content": 1}).to_list(length=None)
+    return text_files, chunks
+
+
+async def delete_text_chunks(title: str) -> int:
+    result = await text_chunks_collection.delete_many({"title": title})
+    return result.deleted_count
+
+
+async def insert_text_chunks(chunks: List[dict]):
+    if chunks:
+        await text_chunks_collection.insert_many(chunks, ordered=False)
+
+
+@timed_stage("chunk_lookup")
+async def find_text_chunks(ids: List[str]) -> Dict[str, dict]:
+    chunks = {}
+    missing = []
+    for id in ids:
+        chunk = _cache.get(("chunk", id))
+        if chunk is not None:
+            chunks[id] = chunk
+        elif id not in _missing_chunk_ids:
+            missing.append(id)
+    if missing:
+        async for chunk in text_chunks_collection.find({"_id": {"$in": missing}}):
+            chunks[chunk["_id"]] = chunk
+            _cache_chunk(chunk)
+        # Document-level vectors have no chunk; remember that so they do not cost a query every turn
+        _missing_chunk_ids.update(id for id in missing if id not in chunks)
+    return chunks
+
+
+async def warm_text_file_cache():
+    _known_documents.clear()
+    async for pdf_file in text_files_collection.find({}):
+        _known_documents[pdf_file["_id"]] = (pdf_file["title"], pdf_file.get("version", 0))
+        _cache_text_file(_to_text_file(pdf_file))
+    async for chunk in text_chunks_collection.find({}):
+        _cache_chunk(chunk)
+
+
+async def _poll_text_file_versions():
+    current = {}
+    async for pdf_file in text_files_collection.find({}, {"title": 1, "version": 1}):
+        current[pdf_file["_id"]] = (pdf_file["title"], pdf_file.get("version", 0))
+    changed = {title for id, (title, version) in current.items() if _known_documents.get(id) != (title, version)}
+    changed.update(title for id, (title, _) in _known_documents.items() if id not in current)
+    _known_documents.clear()
+    _known_documents.update(current)
+    for title in changed:
+        _notify_text_file_changed(title)
+
+
+# Events after which the stream carries no further changes of the collection
+_STREAM_ENDING_EVENTS = {"drop", "rename", "dropDatabase", "invalidate"}
+
+
+def _handle_text_file_change(change: dict) -> bool:
+    """
+    Applies one change stream event to the cache.
+
+    Returns:
+        bool: False if the event ended the stream, after which every cached document is invalidated.
+    """
+    if change.get("operationType") in _STREAM_ENDING_EVENTS:
+        _invalidate_all_text_files()
+        return False
+    document = change.get("fullDocument") or {}
+    document_id = (change.get("documentKey") or {}).get("_id")
+    title = document.get("title") or _known_documents.get(document_id, (None, None))[0]
+    if change["operationType"] == "delete":
+        _known_documents.pop(document_id, None)
+    elif document:
+        _known_documents[document_id] = (document["title"], document.get("version", 0))
+    if title:
+        _notify_text_file_changed(title)
+    return True
+
+
+async def watch_text_files(poll_interval: float = text_file_cache_settings.POLL_INTERVAL_SECONDS):
+    try:
+        async with text_files_collection.watch(full_document="updateLookup") as stream:
+            async for change in stream:
+                try:
+                    if not _handle_text_file_change(change):
+                        break
+                except Exception:
+                    logger.exception("Failed to apply a text file change")
+    except PyMongoError:
+        # Change streams need a replica set; standalone servers fall back to polling the version field
+        pass
+    # After the stream ends, polling rebuilds the known versions from scratch
+    while True:
+        await asyncio.sleep(poll_interval)
+        try:
+            await _poll_text_file_versions()
+        except PyMongoError:
+            pass
+        except Exception:
+            logger.exception("Failed to poll text file versions")
+
+
+def start_text_file_watcher():
+    global _watcher_task
+    if _watcher_task is None or _watcher_task.done():
+        _watcher_task = asyncio.create_task(watch_text_files())
+
+
+async def stop_text_file_watcher():
+    global _watcher_task
+    if _watcher_task is not None:
+        _watcher_task.cancel()
+        try:
+            await _watcher_task
+        except asyncio.CancelledError:
+            pass
+        _watcher_task = None
+
+
+def text_file_cache_stats() -> dict:
+    return {"hits": _cache.hits, "misses": _cache.misses, "entries": len(_cache), "bytes": _cache.total_bytes}
+
+
+cache_requests.add_source(lambda: [(("text_file", "hit"), _cache.hits), (("text_file", "miss"), _cache.misses)])
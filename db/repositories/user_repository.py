@@ -1,11 +1,19 @@
-from datetime import datetime
-from typing import Optional, List
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional, Tuple
 from bson import ObjectId
 
-from core.security import get_password_hash
+from core.cache import TTLCache
+from core.config import auth_settings, message_storage_settings
+from core.metrics import timed_stage, cache_requests
+from core.security import aget_password_hash
 from db.database import users_collection, messages_collection
 from db.models.message import Message
-from db.models.user import User
+from db.models.user import User, ANONYMOUS_USERNAME_PREFIX
+from db.repositories.message_buckets import message_buckets
+from db.repositories.message_writer import message_writer
+
+_user_cache = TTLCache(auth_settings.USER_CACHE_MAX_SIZE, auth_settings.USER_CACHE_TTL_SECONDS)
+cache_requests.add_source(lambda: [(("user", "hit"), _user_cache.hits), (("user", "miss"), _user_cache.misses)])
 
 
 async def get_user_by_username(username: str) -> Optional[User]:
@@ -16,6 +24,19 @@ async def get_user_by_username(username: str) -> Optional[User]:
     return None
 
 
+async def get_cached_user_by_username(username: str) -> Optional[User]:
+    user = _user_cache.get(username)
+    if user is None:
+        user = await get_user_by_username(username)
+        if user:
+            _user_cache.set(username, user)
+    return user
+
+
+def invalidate_cached_user(username: str):
+    _user_cache.pop(username)
+
+
 async def get_user_by_id(user_id: str) -> Optional[User]:
     user_data = await users_collection.find_one({"_id": ObjectId(user_id)})
     if user_data:
@@ -27,44 +48,168 @@ async def get_user_by_id(user_id: str) -> Optional[User]:
 async def create_user(username: str, password: str) -> str:
     user_dict = {
         "username": username,
-        "hashed_password": get_password_hash(password),
+        "hashed_password": await aget_password_hash(password),
         "messages": [],
         "_id": ObjectId()  # Assign an ObjectId
     }
     result = await users_collection.insert_one(user_dict)
+    invalidate_cached_user(username)
     return str(result.inserted_id)
 
 
-async def create_message(username: str, content: str, is_user: bool = True) -> str:
+@timed_stage("message_insert")
+async def create_message(username: str, content: str, is_user: bool = True,
+                         created_at: Optional[datetime] = None) -> str:
+    message_id = ObjectId()
     message_dict = {
-        "messageId": str(ObjectId()),
+        "_id": message_id,
+        "messageId": str(message_id),
         "sender": username,
         "text": content,
         "is_user": is_user,
-        "createdAt": datetime.utcnow(),
+        "createdAt": created_at or datetime.utcnow(),
         "likes": 0,
         "dislikes": 0,
         "rating": None,
         "alert": False
     }
-    await messages_collection.insert_one(message_dict)
+    if message_storage_settings.ANONYMOUS_TTL_SECONDS and message_buckets is None \
+            and username.startswith(ANONYMOUS_USERNAME_PREFIX):
+        message_dict["expiresAt"] = message_dict["createdAt"] + \
+            timedelta(seconds=message_storage_settings.ANONYMOUS_TTL_SECONDS)
+    if message_writer is not None:
+        await message_writer.enqueue(message_dict)
+    elif message_buckets is not None:
+        await message_buckets.insert_one(message_dict)
+    else:
+        await messages_collection.insert_one(message_dict)
     return message_dict['messageId']
 
 
+MESSAGE_PROJECTION = {"_id": 1, "text": 1, "is_user": 1, "createdAt": 1}
+
+
+def encode_message_cursor(created_at: datetime, message_id) -> str:
+    return f"{created_at.isoformat()}/{message_id}"
+
+
+def decode_message_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    created_at, _, message_id = cursor.rpartition("/")
+    if not ObjectId.is_valid(message_id):
+        raise ValueError(f"Invalid message cursor: {cursor}")
+    return datetime.fromisoformat(created_at), ObjectId(message_id)
+
+
+def _messages_query(username: str, before: Optional[str] = None) -> dict:
+    query = {"sender": username}
+    if before:
+        created_at, message_id = decode_message_cursor(before)
+        query["$or"] = [
+            {"createdAt": {"$lt": created_at}},
+            {"createdAt": created_at, "_id": {"$lt": message_id}},
+        ]
+    return query
+
+
+def _pending_messages(username: str, before: Optional[str] = None) -> List[dict]:
+    """
+    Returns the user's messages still in the write-behind buffer, restricted to those older than the cursor.
+    """
+    if message_writer is None:
+        return []
+    pending = message_writer.pending_for(username)
+    if before and pending:
+        created_at, message_id = decode_message_cursor(before)
+        pending = [message for message in pending if (message["createdAt"], message["_id"]) < (created_at, message_id)]
+    return pending
+
+
+def _merge_pending(messages: List[dict], pending: List[dict], limit: int, newest_first: bool = True) -> List[dict]:
+    """
+    Adds buffered messages that are not stored yet to a page of stored messages, keeping its order and limit.
+    """
+    if not pending:
+        return messages
+    stored_ids = {message["_id"] for message in messages}
+    messages = messages + [message for message in pending if message["_id"] not in stored_ids]
+    messages.sort(key=lambda message: (message["createdAt"], message["_id"]), reverse=newest_first)
+    return messages[:limit] if limit else messages
+
+
+def _to_message(message: dict) -> Message:
+    return Message(**{**message, 'messageId': str(message['_id']), '_id': str(message['_id'])})
+
+
+@timed_stage("message_query")
+async def get_messages_by_username(username: str, limit: int = 0, skip: int = 0,
+                                   before: Optional[str] = None) -> List[Message]:
+    # Snapshot the write-behind buffer before querying, so a message flushed meanwhile is still seen once
+    pending = _pending_messages(username, before) if not skip else []
+    if message_buckets is not None:
+        messages = await message_buckets.latest(username, limit, skip,
+                                                decode_message_cursor(before) if before else None)
+    else:
+        cursor = messages_collection.find(_messages_query(username, before)) \
+            .sort([("createdAt", -1), ("_id", -1)]).skip(skip).limit(limit)
+        messages = await cursor.to_list(length=limit or None)
+    return [_to_message(message) for message in _merge_pending(messages, pending, limit)]
+
+
+async def iter_raw_messages(username: str, limit: int = 0, before: Optional[str] = None) -> AsyncIterator[dict]:
+    pending = _pending_messages(username, before)
+    if message_buckets is not None:
+        messages = await message_buckets.latest(username, limit,
+                                                before=decode_message_cursor(before) if before else None)
+    elif pending:
+        # Buffered messages have to be merged in order, so the page is read whole rather than streamed
+        messages = await messages_collection.find(_messages_query(username, before), MESSAGE_PROJECTION) \
+            .sort([("createdAt", -1), ("_id", -1)]).limit(limit).to_list(length=limit or None)
+    else:
+        cursor = messages_collection.find(_messages_query(username, before), MESSAGE_PROJECTION) \
+            .sort([("createdAt", -1), ("_id", -1)]).limit(limit)
+        async for message in cursor:
+            yield message
+        return
+    for message in _merge_pending(messages, pending, limit):
+        yield {key: message[key] for key in MESSAGE_PROJECTION}
+
+
 async def get_all_messages_by_username(username: str) -> List[Message]:
-    messages = await messages_collection.find({"sender": username}).sort("createdAt", -1).to_list(length=None)
-    return [Message(**{**message, 'messageId': str(message['_id']), '_id': str(message['_id'])}) for message in
-            messages]
+    return await get_messages_by_username(username)
 
 
 async def get_last_n_messages(username: str, n: int) -> List[Message]:
-    all_messages = await get_all_messages_by_username(username)
-    return all_messages[:n]  # Get the last n messages
+    if n <= 0:
+        return []
+    return await get_messages_by_username(username, limit=n)  # Get the last n messages
+
+
+async def get_messages_since(username: str, since: Optional[datetime] = None, limit: int = 0) -> List[Message]:
+    """
+    Returns the oldest stored messages created after the given time, oldest first.
+    Messages still in the write-behind buffer are not included.
+    """
+    if message_buckets is not None:
+        return [_to_message(message) for message in await message_buckets.since(username, since, limit)]
+    query = {"sender": username}
+    if since is not None:
+        query["createdAt"] = {"$gt": since}
+    messages = await messages_collection.find(query).sort([("createdAt", 1), ("_id", 1)]).limit(limit) \
+        .to_list(length=limit or None)
+    return [_to_message(message) for message in messages]
 
 
 async def get_first_n_messages(username: str, n: int) -> List[Message]:
-    all_messages = await get_all_messages_by_username(username)
-    return all_messages[-n:]  # Get the first n messages
+    if n <= 0:
+        return []
+    pending = _pending_messages(username)
+    if message_buckets is not None:
+        messages = await message_buckets.since(username, limit=n)
+    else:
+        messages = await messages_collection.find({"sender": username}) \
+            .sort([("createdAt", 1), ("_id", 1)]).limit(n).to_list(length=n)
+    messages = _merge_pending(messages, pending, n, newest_first=False)
+    return [_to_message(message) for message in reversed(messages)]  # Get the first n messages
 
 
 def join_messages(messages: List[Message]) -> str:
@@ -72,5 +217,9 @@ def join_messages(messages: List[Message]) -> str:
 
 
 async def delete_messages_by_sender(username: str) -> int:
+    if message_writer is not None:
+        message_writer.discard(username)
+    if message_buckets is not None:
+        return await message_buckets.delete_sender(username)
     result = await messages_collection.delete_many({"sender": username})
     return result.deleted_count
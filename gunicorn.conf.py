@@ -0,0 +1,43 @@
+import logging
+import os
+import subprocess
+import sys
+
+from application.routing_snapshot import current_version
+from core.config import snapshot_settings, vector_store_settings  # Also loads .env for the settings below
+
+
+def _available_cpus() -> int:
+    # CPUs this process may run on, which honours taskset and cpusets unlike cpu_count()
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(_available_cpus())))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Each worker imports the app itself: database and HTTP clients must not be shared across a fork
+preload_app = False
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+
+def on_starting(server):
+    """
+    Publishes the first routing snapshot before the workers start, so they all map the same files.
+
+    Runs in a child process so the master never opens database or vector store connections.
+    """
+    if vector_store_settings.BACKEND == "local" and server.cfg.workers > 1:
+        # Each worker would rewrite the index files from its own copy, losing the others' inserts
+        logging.getLogger("gunicorn.error").warning(
+            "VECTOR_STORE_BACKEND=local supports a single writer; run one worker (WEB_CONCURRENCY=1) or use Pinecone")
+    if not snapshot_settings.ENABLED or current_version(snapshot_settings.PATH) is not None:
+        return
+    result = subprocess.run([sys.executable, "-m", "application.ingestion", "--snapshot-only"])
+    if result.returncode != 0:
+        # Workers serve from the database and the vector store until a snapshot is published
+        logging.getLogger("gunicorn.error").warning("Publishing the routing snapshot failed")